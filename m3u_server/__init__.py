@@ -1,11 +1,14 @@
 # m3u_server/__init__.py
 import os
 import logging
-from flask import Flask, request, render_template_string
+from flask import Flask, request
 from flask_sqlalchemy import SQLAlchemy
 from flask_wtf.csrf import CSRFProtect
+from werkzeug.exceptions import HTTPException
+from sqlalchemy import event, inspect, text
+from sqlalchemy.orm import Session
+from sqlalchemy.schema import CreateIndex
 from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
 from .config import Config
 
 # --- Initialize Extensions ---
@@ -13,6 +16,14 @@ db = SQLAlchemy()
 csrf = CSRFProtect()
 scheduler = BackgroundScheduler(daemon=True, timezone="UTC")
 
+def read_session():
+    """
+    Returns a standalone session for read-only handlers (e.g. the DataTables poll).
+    It never autoflushes or expires rows, and stays outside the request's db.session
+    identity map. The caller closes it.
+    """
+    return Session(db.engine, autoflush=False, expire_on_commit=False)
+
 def create_app(config_class=Config):
     """
     Creates and configures the Flask application instance.
@@ -39,6 +50,8 @@ def create_app(config_class=Config):
     csrf.init_app(app)
 
     with app.app_context():
+        configure_sqlite_pragmas(app)
+
         # --- Import and Register Blueprints ---
         from .routes.main import main_bp
         from .routes.sources import sources_bp
@@ -57,21 +70,116 @@ def create_app(config_class=Config):
         # --- Database and Scheduler Initialization ---
         initialize_database_and_scheduler(app)
 
+    # Compiled once; the handler below only renders it
+    error_template = app.jinja_env.from_string("""
+        <!doctype html><title>500 Internal Server Error</title>
+        <h1>Internal Server Error</h1>
+        <p>The server encountered an internal error and was unable to complete your request. The error has been logged.</p>
+        """)
+
+    # HTTP errors (404, 405, abort(...)) keep their own status and page instead of becoming a logged 500
+    @app.errorhandler(HTTPException)
+    def handle_http_exception(e):
+        return e
+
     # Define a robust error handler
     @app.errorhandler(Exception)
     def handle_exception(e):
         app.logger.error(f"Unhandled exception on {request.path} [{request.method}]", exc_info=e)
         if app.debug:
             raise e
-        error_template = """
-        <!doctype html><title>500 Internal Server Error</title>
-        <h1>Internal Server Error</h1>
-        <p>The server encountered an internal error and was unable to complete your request. The error has been logged.</p>
-        """
-        return render_template_string(error_template), 500
+        return error_template.render(), 500
 
     return app
 
+def configure_sqlite_pragmas(app):
+    """
+    Registers a connect hook that applies SQLITE_PRAGMAS to every new connection
+    on the application's engine. Does nothing for non-SQLite databases.
+    """
+    engine = db.engine
+    if engine.dialect.name != 'sqlite':
+        return
+    pragmas = app.config.get('SQLITE_PRAGMAS', {})
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+def ensure_indexes(app):
+    """
+    Brings the indexes of an existing database in line with the models.
+    db.create_all() only creates indexes together with brand-new tables, so missing ones
+    are created here, and 'ix_' indexes the models no longer declare are dropped.
+    Refreshes planner statistics when anything changed.
+    """
+    inspector = inspect(db.engine)
+    created, dropped = [], []
+    for table in db.metadata.sorted_tables:
+        existing = {index['name'] for index in inspector.get_indexes(table.name)}
+        declared = {index.name for index in table.indexes}
+        for index in table.indexes:
+            if index.name not in existing:
+                # IF NOT EXISTS: another worker booting at the same time may have just created it
+                with db.engine.begin() as conn:
+                    conn.execute(CreateIndex(index, if_not_exists=True))
+                created.append(index.name)
+        for name in sorted(existing - declared):
+            if name and name.startswith('ix_'):
+                with db.engine.begin() as conn:
+                    conn.execute(text(f'DROP INDEX IF EXISTS "{name}"'))
+                dropped.append(name)
+    if created or dropped:
+        with db.engine.begin() as conn:
+            conn.execute(text("ANALYZE"))
+    if created:
+        app.logger.info(f"Created missing indexes: {', '.join(created)}")
+    if dropped:
+        app.logger.info(f"Dropped obsolete indexes: {', '.join(dropped)}")
+
+CHANNEL_SEARCH_DDL = (
+    """CREATE TRIGGER IF NOT EXISTS channels_fts_ai AFTER INSERT ON channels BEGIN
+        INSERT INTO channels_fts(rowid, name, category, tvg_id) VALUES (new.id, new.name, new.category, new.tvg_id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS channels_fts_ad AFTER DELETE ON channels BEGIN
+        INSERT INTO channels_fts(channels_fts, rowid, name, category, tvg_id) VALUES ('delete', old.id, old.name, old.category, old.tvg_id);
+    END""",
+    # Refreshes rewrite these columns with unchanged values; only real changes touch the index
+    """CREATE TRIGGER IF NOT EXISTS channels_fts_au AFTER UPDATE OF name, category, tvg_id ON channels
+    WHEN old.name IS NOT new.name OR old.category IS NOT new.category OR old.tvg_id IS NOT new.tvg_id BEGIN
+        INSERT INTO channels_fts(channels_fts, rowid, name, category, tvg_id) VALUES ('delete', old.id, old.name, old.category, old.tvg_id);
+        INSERT INTO channels_fts(rowid, name, category, tvg_id) VALUES (new.id, new.name, new.category, new.tvg_id);
+    END""",
+)
+
+def ensure_channel_search_index(app):
+    """
+    Creates the FTS5 trigram index used for substring channel search, plus the triggers that
+    keep it in sync with the channels table. Sets CHANNEL_SEARCH_FTS so the search route
+    falls back to LIKE when this SQLite build lacks FTS5/trigram support.
+    """
+    app.config['CHANNEL_SEARCH_FTS'] = False
+    if db.engine.dialect.name != 'sqlite':
+        return
+    try:
+        with db.engine.begin() as conn:
+            exists = conn.execute(text("SELECT 1 FROM sqlite_master WHERE type='table' AND name='channels_fts'")).first()
+            conn.execute(text(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS channels_fts USING fts5("
+                "name, category, tvg_id, content='channels', content_rowid='id', tokenize='trigram')"
+            ))
+            for ddl in CHANNEL_SEARCH_DDL:
+                conn.execute(text(ddl))
+            if not exists:
+                conn.execute(text("INSERT INTO channels_fts(channels_fts) VALUES ('rebuild')"))
+                app.logger.info("Built channel search index.")
+        app.config['CHANNEL_SEARCH_FTS'] = True
+    except Exception as e:
+        app.logger.warning(f"FTS5 channel search unavailable, using LIKE search: {e}")
+
 def initialize_database_and_scheduler(app):
     """
     Ensures database tables exist and initializes/starts the scheduler.
@@ -81,15 +189,32 @@ def initialize_database_and_scheduler(app):
         from . import models
         db.create_all()
         app.logger.info("SQLAlchemy tables checked/created.")
+        ensure_indexes(app)
+        ensure_channel_search_index(app)
     except Exception as e:
         app.logger.error(f"Error during initial db.create_all(): {e}", exc_info=True)
         
+    if not app.config.get('RUN_SCHEDULER', True):
+        app.logger.info("RUN_SCHEDULER is off; background jobs are not started in this process.")
+        return
+
+    if app.config.get('EXTERNAL_SCHEDULER', False):
+        start_job_store_client(app)
+        return
+
     if not scheduler.running:
+        # Imported here so processes that never run the scheduler skip the jobstore setup
+        from apscheduler.executors.pool import ThreadPoolExecutor
+        from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
         jobstore_url = app.config['SQLALCHEMY_DATABASE_URI']
         scheduler.add_jobstore(SQLAlchemyJobStore(url=jobstore_url), 'default')
+        # Refreshes of different sources run side by side (downloads and parsing overlap; SQLite
+        # still serializes their write batches)
+        scheduler.add_executor(ThreadPoolExecutor(max_workers=app.config['SCHEDULER_MAX_WORKERS']), 'default')
         
         app.logger.info("Reloading and scheduling background jobs...")
         from . import scheduler_jobs
+        scheduler_jobs.set_job_app(app)
         
         scheduler.remove_all_jobs()
         scheduler.add_job(
@@ -99,8 +224,7 @@ def initialize_database_and_scheduler(app):
         )
         app.logger.info("Scheduled daily cleanup job.")
 
-        scheduler_jobs.schedule_all_source_refreshes()
-        scheduler_jobs.schedule_all_epg_refreshes()
+        scheduler_jobs.schedule_all_refreshes()
 
         try:
             scheduler.start()
@@ -109,3 +233,19 @@ def initialize_database_and_scheduler(app):
             app.logger.error(f"APScheduler failed to start: {e}", exc_info=True)
     else:
         app.logger.info("APScheduler is a'ready running.")
+
+def start_job_store_client(app):
+    """
+    Starts the scheduler paused on the shared job store, for web processes whose jobs are run
+    by run_scheduler.py. Jobs added or removed by the routes are written to the database;
+    nothing is executed in this process.
+    """
+    if scheduler.running:
+        return
+    from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+    # The scheduler process only sees a new job on its next poll, so one-off jobs must stay
+    # runnable that long instead of being dropped as misfired after the default 1 second
+    scheduler.configure(timezone='UTC', job_defaults={'misfire_grace_time': app.config['SCHEDULER_POLL_SECONDS'] * 6})
+    scheduler.add_jobstore(SQLAlchemyJobStore(url=app.config['SQLALCHEMY_DATABASE_URI']), 'default')
+    scheduler.start(paused=True)
+    app.logger.info("EXTERNAL_SCHEDULER is on; jobs are recorded in the shared job store for run_scheduler.py.")
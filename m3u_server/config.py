@@ -29,7 +29,43 @@ class Config:
     SQLALCHEMY_TRACK_MODIFICATIONS = False
     SQLALCHEMY_ECHO = False
 
+    # Pooled connections are shared between request threads and scheduler jobs;
+    # wait up to 30s for the write lock instead of failing with "database is locked".
+    # The pool is sized for gunicorn's request threads plus concurrently running refresh jobs;
+    # raise DB_POOL_SIZE/DB_MAX_OVERFLOW when running gunicorn with more threads.
+    # (No pre-ping/recycle: a local SQLite file has no server side to drop idle connections.)
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 10)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 20)),
+        'connect_args': {'check_same_thread': False, 'timeout': 30},
+    }
+
+    # PRAGMAs applied to every new SQLite connection. WAL lets the playlist/EPG
+    # endpoints keep reading while refresh jobs write large batches.
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'temp_store': 'MEMORY',
+        'mmap_size': 268435456,
+        'cache_size': -64000,
+    }
+
+    # --- Scheduler ---
+    # Set RUN_SCHEDULER=false for one-off processes (e.g. setup_db.py) that only need the app
+    # and database, so they don't start the background refresh jobs.
+    RUN_SCHEDULER = os.environ.get('RUN_SCHEDULER', 'true').lower() == 'true'
+    # Set EXTERNAL_SCHEDULER=true on web processes when run_scheduler.py runs the jobs in its own
+    # process: the web app then only records job changes in the shared job store.
+    EXTERNAL_SCHEDULER = os.environ.get('EXTERNAL_SCHEDULER', 'false').lower() == 'true'
+    # How often run_scheduler.py checks the job store for jobs added by the web processes
+    SCHEDULER_POLL_SECONDS = int(os.environ.get('SCHEDULER_POLL_SECONDS', 10))
+    # Background jobs that may run at once (one per refreshing source); keep below the DB pool size
+    SCHEDULER_MAX_WORKERS = int(os.environ.get('SCHEDULER_MAX_WORKERS', 8))
+
     # --- Application-Specific Settings ---
+    # EPG times are stored in UTC; the channel manager shows them in this IANA zone
+    # (e.g. 'Europe/London'). Unset means the server's local time, which honours TZ.
+    DISPLAY_TIMEZONE = os.environ.get('DISPLAY_TIMEZONE') or None
     EPG_DATA_RETENTION_HOURS = 72
     CHANNEL_DATA_RETENTION_DAYS = 3
 
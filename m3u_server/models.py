@@ -1,7 +1,60 @@
 # m3u_server/models.py
+import re
+import functools
+import threading
 from datetime import datetime
+from sqlalchemy import event, table, column, func
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import Session
 from . import db
 
+# --- Data version ---
+# Changes after every commit, so read-side caches can tell when their contents may be stale.
+# ORM commits in this process bump it directly; commits from other processes (gunicorn workers,
+# run_scheduler.py, setup_db.py) are noticed through SQLite's PRAGMA data_version.
+_data_version = 0
+_data_version_lock = threading.Lock()
+
+@event.listens_for(Session, 'after_commit')
+def _bump_data_version(session):
+    global _data_version
+    with _data_version_lock:
+        _data_version += 1
+
+# Per engine: the connection PRAGMA data_version is polled on, and its last reading
+_version_watchers = {}
+
+def _poll_external_commits():
+    """
+    Bumps the data version when another connection has committed since the last poll.
+    PRAGMA data_version only moves for other connections' commits and its value is per
+    connection, so one long-lived connection that never writes is kept for polling; its
+    first reading is just the baseline.
+    """
+    global _data_version
+    engine = db.engine
+    if engine.dialect.name != 'sqlite':
+        return
+    with _data_version_lock:
+        watcher = _version_watchers.get(engine)
+        if watcher is None:
+            # Held for the life of the process, outside the request/job checkouts
+            connection = engine.raw_connection()
+            _version_watchers[engine] = watcher = {'connection': connection, 'value': None}
+        cursor = watcher['connection'].cursor()
+        try:
+            value = cursor.execute("PRAGMA data_version").fetchone()[0]
+        finally:
+            cursor.close()
+        if watcher['value'] is not None and value != watcher['value']:
+            _data_version += 1
+        watcher['value'] = value
+
+def data_version():
+    """Returns a counter that changes after any commit to the database, from any process."""
+    _poll_external_commits()
+    return _data_version
+
 class M3uSource(db.Model):
     __tablename__ = 'm3u_sources'
     id = db.Column(db.Integer, primary_key=True)
@@ -12,6 +65,14 @@ class M3uSource(db.Model):
 
 class Channel(db.Model):
     __tablename__ = 'channels'
+    __table_args__ = (
+        # Lets the playlist query walk enabled channels in (category, name) order without a sort
+        db.Index('ix_channels_playlist', 'enabled', 'category', 'name', 'id'),
+        # Matches the channel manager order (enabled DESC, name, id) for keyset pagination
+        db.Index('ix_channels_seek', db.desc('enabled'), 'name', 'id'),
+        # Partial index holding only the channels published in epg.xml, in tvg_id order
+        db.Index('ix_channels_epg', 'tvg_id', sqlite_where=db.text('enabled = 1 AND tvg_id IS NOT NULL')),
+    )
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String, nullable=False, index=True)
     category = db.Column(db.String, index=True)
@@ -19,13 +80,27 @@ class Channel(db.Model):
     tvg_name = db.Column(db.String) # Name for EPG matching
     tvg_logo = db.Column(db.String)
     channel_num = db.Column(db.Integer)
-    enabled = db.Column(db.Boolean, nullable=False, default=True, index=True)
+    enabled = db.Column(db.Boolean, nullable=False, default=True) # Lookups use the composite indexes above
     last_seen = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     
     # Relationships
     urls = db.relationship('Url', backref='channel', lazy=True, cascade="all, delete-orphan")
     epg_data = db.relationship('EpgData', backref='channel', lazy=True, cascade="all, delete-orphan")
 
+    @hybrid_property
+    def display_name(self):
+        """The name published as tvg-name: tvg_name when set, otherwise the channel name."""
+        return self.tvg_name or self.name
+
+    @display_name.expression
+    def display_name(cls):
+        # NULLIF keeps an empty tvg_name falling back to name, as in the Python side
+        return func.coalesce(func.nullif(cls.tvg_name, ''), cls.name)
+
+# FTS5 (trigram) mirror of channels.name/category/tvg_id used by the channel search.
+# Not a mapped model: it is created and kept in sync by ensure_channel_search_index() and triggers.
+channels_fts = table('channels_fts', column('rowid'))
+
 class Url(db.Model):
     __tablename__ = 'urls'
     id = db.Column(db.Integer, primary_key=True)
@@ -43,16 +118,32 @@ class EpgSource(db.Model):
 
 class EpgData(db.Model):
     __tablename__ = 'epg_data'
+    __table_args__ = (
+        # Per-channel programme lookups in start order; also serves plain channel_tvg_id filters
+        db.Index('ix_epg_lookup', 'channel_tvg_id', 'start_time'),
+        # Range scans on end_time: the cleanup job's expiry delete
+        db.Index('ix_epg_end_time', 'end_time'),
+    )
     id = db.Column(db.Integer, primary_key=True)
-    channel_tvg_id = db.Column(db.String, db.ForeignKey('channels.tvg_id'), nullable=False, index=True)
+    channel_tvg_id = db.Column(db.String, db.ForeignKey('channels.tvg_id'), nullable=False)
     title = db.Column(db.String, nullable=False)
     start_time = db.Column(db.DateTime, nullable=False, index=True)
     end_time = db.Column(db.DateTime, nullable=False)
     description = db.Column(db.Text)
 
+@functools.lru_cache(maxsize=1024)
+def compile_filter_pattern(pattern, flags=re.IGNORECASE):
+    """Compiles a filter pattern once per process; raises re.error for invalid patterns."""
+    return re.compile(pattern, flags)
+
 class Filter(db.Model):
     __tablename__ = 'filters'
     id = db.Column(db.Integer, primary_key=True)
     pattern = db.Column(db.String, nullable=False, unique=True)
     description = db.Column(db.String)
     enabled = db.Column(db.Boolean, nullable=False, default=True, index=True)
+
+    @property
+    def compiled(self):
+        """The case-insensitive compiled pattern, shared by every Filter row with the same text."""
+        return compile_filter_pattern(self.pattern)
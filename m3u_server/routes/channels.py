@@ -1,13 +1,76 @@
 # m3u_server/routes/channels.py
-from flask import Blueprint, render_template, request, flash, redirect, url_for, jsonify, current_app
-from sqlalchemy import or_, func, desc, asc
+from flask import Blueprint, render_template, request, flash, redirect, url_for, jsonify, current_app, abort, Response
+from sqlalchemy import or_, func, desc, asc, tuple_, select, insert, update, exists, literal, literal_column, bindparam
 from datetime import datetime, timedelta, timezone
-from .. import db, csrf
-from ..models import Channel, EpgData, Url
+import hashlib
+import threading
+import time
+import uuid
+from functools import lru_cache
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+from itertools import groupby
+from operator import itemgetter
+from .. import db, csrf, read_session
+from ..models import Channel, EpgData, Url, channels_fts, data_version
 from ..forms import AddChannelForm, EditChannelForm
+from ..scheduler_jobs import chunked
 
 channels_bp = Blueprint('channels', __name__)
 
+# --- Statements built once at import; each call only binds parameters ---
+_CHANNEL_COUNT_STMT = select(func.count(Channel.id))
+# Upcoming programmes for the tvg_ids on a DataTables page
+_PAGE_EPG_STMT = select(EpgData.channel_tvg_id, EpgData.start_time, EpgData.title).where(
+    EpgData.channel_tvg_id.in_(bindparam('tvg_ids', expanding=True)),
+    EpgData.start_time < bindparam('until'),
+    EpgData.end_time > bindparam('now')
+).order_by(EpgData.channel_tvg_id, EpgData.start_time)
+_INSERT_URL_STMT = insert(Url.__table__)
+# Flips a channel's enabled flag in place and returns the new value (no row -> unknown id)
+_TOGGLE_STMT = update(Channel.__table__).where(
+    Channel.__table__.c.id == bindparam('cid')
+).values(enabled=~Channel.__table__.c.enabled).returning(Channel.__table__.c.enabled)
+
+# recordsTotal for the DataTables poll. Reused while no commit has happened; the TTL bounds
+# staleness on databases where commits from other processes can't be detected.
+CHANNELS_TOTAL_TTL_SECONDS = 30
+_channels_total_cache = {'ts': 0, 'version': None, 'value': 0}
+_channels_total_lock = threading.Lock()
+
+@lru_cache(maxsize=8)
+def _display_timezone(name):
+    """The tzinfo EPG preview times are shown in: the named IANA zone, or the server's local zone."""
+    if name:
+        try:
+            return ZoneInfo(name)
+        except (ZoneInfoNotFoundError, ValueError) as e:
+            current_app.logger.warning(f"Unknown DISPLAY_TIMEZONE '{name}', showing server local time: {e}")
+    return datetime.now(timezone.utc).astimezone().tzinfo
+
+# Distinguishes ETags issued before a restart, when the data version counter starts over
+_BOOT_TOKEN = uuid.uuid4().hex
+
+def channels_data_etag(form, version):
+    """
+    Weak ETag for a DataTables request: the data version, the current minute (the EPG preview
+    window moves with the clock) and every request parameter except the per-call draw counter.
+    """
+    params = sorted((key, value) for key, value in form.items(multi=True) if key != 'draw')
+    now = datetime.now(timezone.utc)
+    key = f"{_BOOT_TOKEN}:{version}:{now:%Y%m%d%H%M}:{params}"
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+def get_channels_total(session, version):
+    """Returns the total channel count, from cache when still valid for the given data version."""
+    with _channels_total_lock:
+        cache = _channels_total_cache
+        if cache['version'] == version and time.monotonic() - cache['ts'] < CHANNELS_TOTAL_TTL_SECONDS:
+            return cache['value']
+    value = session.execute(_CHANNEL_COUNT_STMT).scalar()
+    with _channels_total_lock:
+        _channels_total_cache.update(ts=time.monotonic(), version=version, value=value)
+    return value
+
 @channels_bp.route('/')
 def manage_channels():
     """Renders the main page for managing channels."""
@@ -20,27 +83,33 @@ def add_channel():
     form = AddChannelForm()
     if form.validate_on_submit():
         try:
-            # Check if a channel with the same name or tvg_id already exists
-            existing_channel = Channel.query.filter(or_(Channel.name == form.name.data, Channel.tvg_id == form.tvg_id.data)).first()
-            if existing_channel:
+            now = datetime.utcnow()
+            channels = Channel.__table__
+            fields = {
+                'name': form.name.data,
+                'category': form.category.data,
+                'tvg_id': form.tvg_id.data,
+                'tvg_logo': form.tvg_logo.data,
+                'channel_num': form.channel_num.data,
+                'last_seen': now,
+                'enabled': True,
+            }
+            # One INSERT ... SELECT ... WHERE NOT EXISTS: the duplicate check and the insert run as a
+            # single statement under SQLite's write lock, so concurrent submits can't both insert.
+            # (No UNIQUE constraint here: imported playlists legitimately reuse channel names.)
+            candidate = select(*(literal(value, channels.c[key].type) for key, value in fields.items())).where(
+                ~exists().where(or_(channels.c.name == form.name.data, channels.c.tvg_id == form.tvg_id.data))
+            )
+            new_channel_id = db.session.execute(
+                insert(channels).from_select(list(fields), candidate).returning(channels.c.id)
+            ).scalar()
+
+            if new_channel_id is None:
                 flash(f'Channel with this name or TVG-ID already exists.', 'warning')
             else:
-                new_channel = Channel(
-                    name=form.name.data,
-                    category=form.category.data,
-                    tvg_id=form.tvg_id.data,
-                    tvg_logo=form.tvg_logo.data,
-                    channel_num=form.channel_num.data,
-                    last_seen=datetime.utcnow()
-                )
-                db.session.add(new_channel)
-                db.session.flush() # Get the ID for the new channel
-
-                new_url = Url(url=form.url.data, channel_id=new_channel.id, last_seen=datetime.utcnow())
-                db.session.add(new_url)
-                
+                db.session.execute(_INSERT_URL_STMT, {'url': form.url.data, 'channel_id': new_channel_id, 'last_seen': now})
                 db.session.commit()
-                flash(f'Channel "{new_channel.name}" and its URL were added successfully.', 'success')
+                flash(f'Channel "{form.name.data}" and its URL were added successfully.', 'success')
                 return redirect(url_for('channels.manage_channels'))
         except Exception as e:
             db.session.rollback()
@@ -54,82 +123,140 @@ def add_channel():
 @csrf.exempt # Exempt this data-only endpoint from CSRF protection
 def get_channels_data():
     """API endpoint for DataTables to fetch channel data."""
+    # Read once: each call polls the database, and the ETag and count cache must agree on it
+    version = data_version()
+    etag = channels_data_etag(request.form, version)
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        response.set_etag(etag, weak=True)
+        return response
+
+    session = read_session()
     try:
         draw = request.form.get('draw', type=int, default=1)
         start = request.form.get('start', type=int, default=0)
         length = request.form.get('length', type=int, default=50)
         search_value = request.form.get('search[value]', default='').strip().lower()
         
-        # Base query
-        query = db.session.query(Channel)
-        records_total = db.session.query(func.count(Channel.id)).scalar()
+        # Base query: only the columns the table shows, as plain rows rather than Channel objects
+        query = session.query(
+            Channel.id, Channel.name, Channel.category, Channel.tvg_id, Channel.tvg_logo, Channel.enabled
+        )
+        records_total = get_channels_total(session, version)
 
-        # Search filter
-        if search_value:
+        # Search filter. The trigram index answers substring matches of 3+ characters;
+        # shorter terms (or builds without FTS5) fall back to a LIKE scan.
+        if search_value and len(search_value) >= 3 and current_app.config.get('CHANNEL_SEARCH_FTS'):
+            phrase = '"' + search_value.replace('"', '""') + '"'
+            query = query.filter(Channel.id.in_(
+                select(channels_fts.c.rowid).where(literal_column('channels_fts').op('MATCH')(phrase))
+            ))
+        elif search_value:
+            # SQLite's LIKE already folds ASCII case (the same folding lower() does), so the
+            # columns are compared as stored instead of lower()-ing every row first
             query = query.filter(or_(
-                func.lower(Channel.name).like(f"%{search_value}%"),
-                func.lower(Channel.category).like(f"%{search_value}%"),
-                func.lower(Channel.tvg_id).like(f"%{search_value}%")
+                Channel.name.like(f"%{search_value}%"),
+                Channel.category.like(f"%{search_value}%"),
+                Channel.tvg_id.like(f"%{search_value}%")
             ))
         
-        records_filtered = query.order_by(None).count()
+        # Without a search the filtered count is the total
+        records_filtered = None if search_value else records_total
 
-        # Order by enabled status first, then by name
-        query = query.order_by(desc(Channel.enabled), asc(Channel.name))
-        
-        channels_page = query.offset(start).limit(length).all()
+        # Order by enabled status first, then by name; id makes the order total so pages can be seeked
+        query = query.order_by(desc(Channel.enabled), asc(Channel.name), asc(Channel.id))
+
+        # Keyset pagination: when the client sends the last row of the previous page,
+        # continue after it instead of making SQLite walk `start` rows.
+        last_id = request.form.get('last_id', type=int)
+        if records_filtered is None and last_id is None:
+            # Searched offset page: the filtered count rides along on every row via a window
+            # function, so page and count come back in one statement.
+            channels_page = query.add_columns(func.count().over().label('total_filtered')).offset(start).limit(length).all()
+            if channels_page:
+                records_filtered = channels_page[0].total_filtered
+            elif start == 0:
+                records_filtered = 0
+        elif last_id is not None:
+            last_enabled = request.form.get('last_enabled', type=int, default=1) == 1
+            last_name = request.form.get('last_name', default='')
+            channels_page = query.filter(
+                Channel.enabled == last_enabled,
+                tuple_(Channel.name, Channel.id) > tuple_(last_name, last_id)
+            ).limit(length).all()
+            # Enabled rows sort first: once they run out, the page continues with the first disabled rows.
+            # Kept as a second range query so each one stays a plain index seek.
+            if last_enabled and (length < 0 or len(channels_page) < length):
+                remaining = length - len(channels_page) if length >= 0 else -1
+                channels_page += query.filter(Channel.enabled == False).limit(remaining).all()
+        else:
+            channels_page = query.offset(start).limit(length).all()
+
+        if records_filtered is None:
+            # Seek pages (and offset pages past the end) carry no window count
+            records_filtered = query.order_by(None).count()
 
         # Get EPG data for the channels on the current page
         now = datetime.now(timezone.utc)
         two_hours_later = now + timedelta(hours=2)
-        channel_ids_on_page = [ch.tvg_id for ch in channels_page if ch.tvg_id]
-        
-        epg_results = db.session.query(EpgData).filter(
-            EpgData.channel_tvg_id.in_(channel_ids_on_page),
-            EpgData.start_time < two_hours_later,
-            EpgData.end_time > now
-        ).order_by(EpgData.start_time).all()
+        # Several channels can share a tvg_id; bind each one once and skip the query when there are none
+        tvg_ids_on_page = {ch.tvg_id for ch in channels_page if ch.tvg_id}
+
+        # Plain (tvg_id, start, title) tuples; descriptions and ORM objects are not needed here.
+        # Chunked because an "All" page can carry more tvg_ids than SQLite accepts as parameters;
+        # each tvg_id falls in one chunk, so rows stay grouped by tvg_id.
+        epg_results = []
+        for tvg_id_chunk in chunked(sorted(tvg_ids_on_page)):
+            epg_results += session.execute(
+                _PAGE_EPG_STMT, {'tvg_ids': tvg_id_chunk, 'until': two_hours_later, 'now': now}
+            ).all()
 
+        # Rows arrive grouped by tvg_id in start order, so groupby builds each channel's list in one pass.
+        # Start times are stored as naive UTC and shown in the display timezone.
+        display_tz = _display_timezone(current_app.config.get('DISPLAY_TIMEZONE'))
         epg_map = {}
-        for epg_item in epg_results:
-            if epg_item.channel_tvg_id not in epg_map:
-                epg_map[epg_item.channel_tvg_id] = []
-            epg_map[epg_item.channel_tvg_id].append(f"{epg_item.start_time.strftime('%H:%M')}: {epg_item.title}")
-
-        # Format data for DataTables
-        data = []
-        for ch in channels_page:
-            epg_html = "<br>".join(epg_map.get(ch.tvg_id, ['<span class="text-muted">No EPG data</span>']))
-            logo_html = f'<img src="{ch.tvg_logo}" alt="logo" class="channel-logo" onerror="this.style.display=\'none\'">' if ch.tvg_logo else ''
-            
-            data.append({
-                "logo": logo_html,
-                "name": ch.name or '',
-                "epg": epg_html,
-                "status": '<span class="badge bg-success">Enabled</span>' if ch.enabled else '<span class="badge bg-secondary">Disabled</span>',
-                "actions": f"""
-                    <button type="button" class="btn btn-outline-primary btn-sm edit-btn" data-id="{ch.id}" data-name="{ch.name}" data-category="{ch.category or ''}" data-tvg-id="{ch.tvg_id or ''}" data-tvg-logo="{ch.tvg_logo or ''}" data-enabled="{1 if ch.enabled else 0}">Edit</button>
-                    <button type="button" class="btn btn-outline-secondary btn-sm toggle-btn" data-id="{ch.id}">{'Disable' if ch.enabled else 'Enable'}</button>
-                """
-            })
-
-        return jsonify({
+        for channel_tvg_id, rows in groupby(epg_results, key=itemgetter(0)):
+            entries = epg_map[channel_tvg_id] = []
+            for _, start_time, title in rows:
+                local_start = start_time.replace(tzinfo=timezone.utc).astimezone(display_tz)
+                entries.append(f"{local_start.hour:02d}:{local_start.minute:02d}: {title}")
+
+        # Raw fields only; the DataTables column renderers in manage_channels.html build the markup
+        data = [{
+            "id": ch.id,
+            "logo": ch.tvg_logo or '',
+            "name": ch.name or '',
+            "epg": epg_map.get(ch.tvg_id, []),
+            "enabled": bool(ch.enabled),
+            "tvg_id": ch.tvg_id or '',
+            "category": ch.category or ''
+        } for ch in channels_page]
+
+        last_row = channels_page[-1] if channels_page else None
+        response = jsonify({
             "draw": draw,
             "recordsTotal": records_total,
             "recordsFiltered": records_filtered,
-            "data": data
+            "data": data,
+            # Seek cursor for the next page
+            "cursor": {"enabled": 1 if last_row.enabled else 0, "name": last_row.name, "id": last_row.id} if last_row else None
         })
+        response.set_etag(etag, weak=True)
+        return response
     except Exception as e:
         current_app.logger.error(f"Error in /api/channels/data: {e}", exc_info=True)
         return jsonify({"error": "Server error."}), 500
+    finally:
+        session.close()
 
 @channels_bp.route('/toggle/<int:channel_id>', methods=['POST'])
 def toggle_channel(channel_id):
     """Toggles the enabled status of a single channel."""
-    channel = Channel.query.get_or_404(channel_id)
-    channel.enabled = not channel.enabled
+    new_state = db.session.execute(_TOGGLE_STMT, {'cid': channel_id}).scalar()
+    if new_state is None:
+        abort(404)
     db.session.commit()
-    return jsonify({'status': 'success', 'new_state': channel.enabled})
+    return jsonify({'status': 'success', 'new_state': bool(new_state)})
 
 @channels_bp.route('/edit/<int:channel_id>', methods=['POST'])
 def edit_channel(channel_id):
@@ -1,9 +1,10 @@
 # m3u_server/routes/epg.py
 from flask import Blueprint, render_template, request, flash, redirect, url_for
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from .. import db, scheduler
 from ..models import EpgSource
 from ..forms import EpgSourceForm, UpdateIntervalForm
-from ..scheduler_jobs import schedule_epg_refresh_job, refresh_single_epg_source
+from ..scheduler_jobs import schedule_epg_refresh_job, unschedule_job, refresh_single_epg_source
 
 epg_bp = Blueprint('epg', __name__)
 
@@ -19,13 +20,16 @@ def add_epg_source():
     form = EpgSourceForm()
     if form.validate_on_submit():
         url = form.epg_url.data
-        if EpgSource.query.filter_by(url=url).first():
+        # One statement: the UNIQUE(url) constraint decides, so concurrent submits can't both insert
+        inserted = db.session.execute(
+            sqlite_insert(EpgSource).values(url=url).on_conflict_do_nothing(index_elements=['url'])
+            .returning(EpgSource.id, EpgSource.refresh_interval_hours)
+        ).first()
+        db.session.commit()
+        if inserted is None:
             flash('EPG Source URL already exists.', 'warning')
         else:
-            new_source = EpgSource(url=url)
-            db.session.add(new_source)
-            db.session.commit()
-            schedule_epg_refresh_job(new_source.id, new_source.url, new_source.refresh_interval_hours)
+            schedule_epg_refresh_job(inserted.id, url, inserted.refresh_interval_hours)
             flash(f'EPG Source added and scheduled for refresh.', 'success')
         return redirect(url_for('epg.manage_epg_sources'))
     return render_template('source_form.html', form=form, title="Add EPG Source")
@@ -34,8 +38,7 @@ def add_epg_source():
 def delete_epg_source(source_id):
     source = EpgSource.query.get_or_404(source_id)
     job_id = f'epg_refresh_{source_id}'
-    if scheduler.get_job(job_id):
-        scheduler.remove_job(job_id)
+    unschedule_job(job_id)
     db.session.delete(source)
     db.session.commit()
     flash('EPG Source deleted and job unscheduled.', 'success')
@@ -51,8 +54,7 @@ def toggle_epg_source(source_id):
         schedule_epg_refresh_job(source.id, source.url, source.refresh_interval_hours)
         flash('EPG Source enabled and job scheduled.', 'success')
     else:
-        if scheduler.get_job(job_id):
-            scheduler.remove_job(job_id)
+        unschedule_job(job_id)
         flash('EPG Source disabled and job unscheduled.', 'warning')
     return redirect(url_for('epg.manage_epg_sources'))
 
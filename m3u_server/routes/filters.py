@@ -1,21 +1,29 @@
 # m3u_server/routes/filters.py
 import re
+from datetime import datetime, timedelta, timezone
 from flask import Blueprint, render_template, request, flash, redirect, url_for
 from .. import db, scheduler
-from ..models import Filter
+from ..models import Filter, compile_filter_pattern
 from ..forms import FilterForm
 from ..scheduler_jobs import disable_channels_without_epg, apply_all_filters_job
 
 filters_bp = Blueprint('filters', __name__)
 
+# Filter edits made within this window are applied by a single job run
+FILTER_APPLY_DELAY_SECONDS = 5
+
 def trigger_apply_filters_job():
-    """Helper function to schedule the apply_all_filters job to run immediately."""
+    """Helper function to schedule the apply_all_filters job to run shortly."""
+    # Each call replaces the pending job and pushes its run time back, so a burst of
+    # edits collapses into one pass over the channels
     scheduler.add_job(
         func=apply_all_filters_job,
         id='manual_apply_all_filters_job',
         name='Manual run of Apply All Filters',
         replace_existing=True,
-        trigger='date' # The 'date' trigger runs the job immediately
+        coalesce=True,
+        trigger='date',
+        run_date=datetime.now(timezone.utc) + timedelta(seconds=FILTER_APPLY_DELAY_SECONDS)
     )
     flash('Task to apply all filters has been triggered. Changes will be reflected shortly.', 'info')
 
@@ -25,8 +33,8 @@ def manage_filters():
     form = FilterForm()
     if form.validate_on_submit():
         try:
-            # Validate regex pattern before saving
-            re.compile(form.pattern.data, re.IGNORECASE)
+            # Validate regex pattern before saving; the compiled result stays cached for the sync job
+            compile_filter_pattern(form.pattern.data)
             
             new_filter = Filter(
                 pattern=form.pattern.data,
@@ -1,13 +1,143 @@
 # m3u_server/routes/main.py
-from flask import Blueprint, redirect, url_for, render_template, abort, current_app, request, Response, stream_with_context
-from sqlalchemy.orm import joinedload
+from flask import Blueprint, redirect, url_for, render_template, current_app, request, Response, stream_with_context
 from datetime import datetime, timezone
-from xml.sax.saxutils import escape
+from werkzeug.http import http_date
+import functools
+import gzip
+import hashlib
+import threading
+import uuid
+from itertools import groupby
+from operator import itemgetter
+from sqlalchemy import func
 from .. import db
-from ..models import Channel, Url, EpgData
+from ..models import Channel, Url, EpgData, data_version
 
 main_bp = Blueprint('main', __name__)
 
+# --- Response caches ---
+# The last fully generated body of each feed (plain and gzipped), keyed by its ETag. Any commit
+# (web edits or scheduler refreshes, in this or another process) bumps the data version, which
+# changes the ETag.
+_RESPONSE_CACHE = {
+    'playlist': {'etag': None, 'body': None, 'gzip_body': None, 'built_at': None},
+    'epg': {'etag': None, 'body': None, 'gzip_body': None, 'built_at': None},
+}
+_RESPONSE_CACHE_LOCK = threading.Lock()
+_BOOT_TOKEN = uuid.uuid4().hex
+
+# M3U and XMLTV compress roughly 10x; level 6 is the usual size/CPU trade-off
+RESPONSE_GZIP_LEVEL = 6
+
+# Playlist entries encoded and yielded together per streamed chunk
+PLAYLIST_STREAM_BATCH = 500
+
+# EPG channel/programme elements encoded and yielded together per streamed chunk
+EPG_STREAM_BATCH = 500
+
+# The EPG drops programmes once they end, so a cached guide is also rebuilt after this long
+EPG_CACHE_SECONDS = 900
+
+def _playlist_etag(epg_url):
+    """Builds the playlist ETag from the data version plus a cheap fingerprint of the enabled channels."""
+    # The fingerprint is a second guard for writes the version counter can't see (non-SQLite databases).
+    enabled_count, last_seen = db.session.query(
+        func.count(Channel.id), func.max(Channel.last_seen)
+    ).filter(Channel.enabled == True).one()
+    key = f"{_BOOT_TOKEN}:{data_version()}:{enabled_count}:{last_seen}:{epg_url}"
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+def _epg_etag():
+    """Builds the EPG ETag from the data version, the newest programme row and the current cache window."""
+    # EPG refreshes delete and re-insert programmes, so max(id) moves on every ingest
+    last_programme_id = db.session.query(func.max(EpgData.id)).scalar()
+    window = int(datetime.now(timezone.utc).timestamp()) // EPG_CACHE_SECONDS
+    key = f"{_BOOT_TOKEN}:{data_version()}:{last_programme_id}:{window}"
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+def _stream_and_cache(name, etag, built_at, chunks):
+    """
+    Passes the encoded chunks through to the client while collecting them. The body (and a
+    gzipped copy for later hits) is cached only when generation completes; errors and client
+    disconnects leave the cache untouched.
+    """
+    parts = []
+    try:
+        for chunk in chunks:
+            parts.append(chunk)
+            yield chunk
+    except Exception as e:
+        current_app.logger.error(f"Database error generating {name}: {e}", exc_info=True)
+        # Re-raised so the server aborts the chunked response: players must not keep a truncated
+        # playlist or guide that looks like a complete 200
+        raise
+    body = b''.join(parts)
+    gzip_body = gzip.compress(body, compresslevel=RESPONSE_GZIP_LEVEL)
+    with _RESPONSE_CACHE_LOCK:
+        _RESPONSE_CACHE[name].update(etag=etag, body=body, gzip_body=gzip_body, built_at=built_at)
+
+def _cached_response(name, etag, generate, headers):
+    """
+    Answers 304 for a matching If-None-Match (or, without one, an If-Modified-Since no older than
+    the cached body), serves the cached body (gzipped when the client accepts it), or streams
+    (and caches) a fresh one. Every response carries the body's ETag and Last-Modified.
+    """
+    # The gzipped variant carries its own ETag, as a different representation of the same data
+    gzip_etag = f'{etag}-gz'
+    headers = {**headers, 'Vary': 'Accept-Encoding'}
+    for candidate in (etag, gzip_etag):
+        if request.if_none_match.contains(candidate):
+            return Response(status=304, headers={'ETag': f'"{candidate}"', 'Vary': 'Accept-Encoding'})
+
+    with _RESPONSE_CACHE_LOCK:
+        entry = _RESPONSE_CACHE[name]
+        cached = (entry['body'], entry['gzip_body'], entry['built_at']) if entry['etag'] == etag else None
+    if cached is not None:
+        body, gzip_body, built_at = cached
+        use_gzip = request.accept_encodings['gzip'] > 0
+        headers['ETag'] = f'"{gzip_etag}"' if use_gzip else f'"{etag}"'
+        headers['Last-Modified'] = http_date(built_at)
+        # If-Modified-Since is only consulted when the client sent no If-None-Match (RFC 9110)
+        if not request.if_none_match and request.if_modified_since and built_at.replace(microsecond=0) <= request.if_modified_since:
+            return Response(status=304, headers={'ETag': headers['ETag'], 'Vary': 'Accept-Encoding'})
+        if use_gzip:
+            return Response(gzip_body, headers={**headers, 'Content-Encoding': 'gzip'})
+        return Response(body, headers=headers)
+    # A fresh body is stamped with the time generation started; the cache keeps the same stamp
+    built_at = datetime.now(timezone.utc)
+    headers['ETag'] = f'"{etag}"'
+    headers['Last-Modified'] = http_date(built_at)
+    return Response(stream_with_context(_stream_and_cache(name, etag, built_at, generate())), headers=headers)
+
+@functools.lru_cache(maxsize=32)
+def _epg_url(url_root):
+    """The external EPG URL for a request root (scheme, host and script path); routed once per root."""
+    return url_for('main.get_epg_xml', _external=True)
+
+def _fmt_xmltv_time(dt):
+    """Formats a stored (naive, UTC) datetime as an XMLTV timestamp without going through strftime."""
+    return f'{dt.year:04d}{dt.month:02d}{dt.day:02d}{dt.hour:02d}{dt.minute:02d}{dt.second:02d} +0000'
+
+def _esc(value):
+    """Escapes a value for XMLTV element text or a double-quoted attribute."""
+    # str.replace runs in C and returns the same object when nothing matches, which beats
+    # a str.translate table for the mostly clean names and titles found in guides
+    if not value:
+        return ''
+    return value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;')
+
+def _fmt_extinf(name, tvg_id, display_name, tvg_logo, category, channel_num):
+    """Formats one '#EXTINF' line; attributes are emitted in a fixed order and skipped when empty."""
+    return ''.join((
+        '#EXTINF:-1',
+        f' tvg-id="{tvg_id}"' if tvg_id else '',
+        f' tvg-name="{display_name}"',
+        f' tvg-logo="{tvg_logo}"' if tvg_logo else '',
+        f' group-title="{category}"' if category else '',
+        f' tvg-chno="{channel_num}"' if channel_num is not None else '',
+        f',{name}',
+    ))
+
 @main_bp.route('/')
 def index():
     """Redirects the root URL to the manage sources page."""
@@ -15,64 +145,79 @@ def index():
 
 @main_bp.route('/playlist.m3u')
 def get_m3u_playlist():
-    """Generates and serves the final M3U playlist file with an EPG link."""
-    try:
-        results = db.session.query(Channel).options(joinedload(Channel.urls)).filter(Channel.enabled == True).order_by(Channel.category, Channel.name).all()
-    except Exception as e:
-        current_app.logger.error(f"Database error generating playlist: {e}", exc_info=True)
-        abort(500, description="Database error occurred while generating the playlist.")
-
-    # Generate the absolute URL for the EPG file
-    epg_url = url_for('main.get_epg_xml', _external=True)
-    
-    # Start the M3U content with the header including the EPG URL
-    m3u_content = [f'#EXTM3U url-tvg="{epg_url}"']
-
-    for channel in results:
-        for url_obj in channel.urls:
-            extinf_parts = ['#EXTINF:-1']
-            
-            if channel.tvg_id: extinf_parts.append(f'tvg-id="{channel.tvg_id}"')
-            if channel.tvg_name: extinf_parts.append(f'tvg-name="{channel.tvg_name}"')
-            else: extinf_parts.append(f'tvg-name="{channel.name}"')
-            if channel.tvg_logo: extinf_parts.append(f'tvg-logo="{channel.tvg_logo}"')
-            if channel.category: extinf_parts.append(f'group-title="{channel.category}"')
-            if channel.channel_num is not None: extinf_parts.append(f'tvg-chno="{channel.channel_num}"')
-
-            extinf_line = " ".join(extinf_parts) + f",{channel.name}"
-            m3u_content.append(extinf_line)
-            m3u_content.append(url_obj.url)
-
-    response_text = "\n".join(m3u_content)
-    return response_text.encode('utf-8'), 200, {
+    """Generates and serves the final M3U playlist file with an EPG link via streaming."""
+    # Absolute URL for the EPG file, as seen by this client
+    epg_url = _epg_url(request.url_root)
+
+    def generate():
+        # Start the M3U content with the header including the EPG URL
+        yield f'#EXTM3U url-tvg="{epg_url}"'.encode('utf-8')
+
+        # Flat column rows (no ORM hydration) ordered server-side so they can be streamed in chunks
+        playlist_query = db.session.query(
+            Channel.id, Channel.name, Channel.tvg_id, Channel.display_name, Channel.tvg_logo, Channel.category, Channel.channel_num, Url.url
+        ).join(Url, Url.channel_id == Channel.id).filter(
+            Channel.enabled == True
+        ).order_by(Channel.category, Channel.name, Channel.id, Url.id)
+
+        # Entries are encoded in blocks of PLAYLIST_STREAM_BATCH so the WSGI server writes
+        # a few large chunks instead of one tiny chunk per URL
+        batch = []
+        current_channel_id = extinf = None
+        for channel_id, name, tvg_id, display_name, tvg_logo, category, channel_num, stream_url in playlist_query.yield_per(1000):
+            # A channel's URLs arrive together; its '#EXTINF' line is formatted once and reused
+            if channel_id != current_channel_id:
+                current_channel_id = channel_id
+                extinf = f"\n{_fmt_extinf(name, tvg_id, display_name, tvg_logo, category, channel_num)}\n"
+            batch.append(extinf + stream_url)
+            if len(batch) >= PLAYLIST_STREAM_BATCH:
+                yield ''.join(batch).encode('utf-8')
+                batch.clear()
+        if batch:
+            yield ''.join(batch).encode('utf-8')
+
+    return _cached_response('playlist', _playlist_etag(epg_url), generate, {
         'Content-Type': 'application/vnd.apple.mpegurl; charset=utf-8',
         'Content-Disposition': 'attachment; filename="playlist.m3u"'
-    }
+    })
 
 @main_bp.route('/epg.xml')
 def get_epg_xml():
     """Generates and serves the final EPG XMLTV file via streaming."""
     def generate():
+        # Elements are joined and encoded in blocks of EPG_STREAM_BATCH, one chunk per block
+        batch = []
+        for element in generate_text():
+            batch.append(element)
+            if len(batch) >= EPG_STREAM_BATCH:
+                yield ''.join(batch).encode('utf-8')
+                batch.clear()
+        if batch:
+            yield ''.join(batch).encode('utf-8')
+
+    def generate_text():
         yield '<?xml version="1.0" encoding="UTF-8"?>\n<tv>\n'
 
         # 1. Output Channels
-        channels_query = Channel.query.filter(Channel.enabled == True, Channel.tvg_id != None)
+        # Plain (tvg_id, name, logo) rows; the guide needs nothing else from Channel
+        channels_query = db.session.query(Channel.tvg_id, Channel.name, Channel.tvg_logo).filter(
+            Channel.enabled == True, Channel.tvg_id != None
+        )
 
         # We also need to get the set of valid tvg_ids to filter the EPG data.
         # Since we are streaming, we can't efficiently iterate the channel list twice without querying twice
         # or storing in memory. The list of channels is usually small enough to store IDs in memory.
         # But for robustness, we use a subquery for the EPG data filtering as planned.
 
-        for channel in channels_query:
-             channel_id_esc = escape(channel.tvg_id)
-             display_name_esc = escape(channel.name)
-
-             yield f'  <channel id="{channel_id_esc}">\n'
-             yield f'    <display-name>{display_name_esc}</display-name>\n'
-             if channel.tvg_logo:
-                 icon_src_esc = escape(channel.tvg_logo)
-                 yield f'    <icon src="{icon_src_esc}" />\n'
-             yield '  </channel>\n'
+        # One string per element
+        for tvg_id, name, tvg_logo in channels_query:
+             icon = f'    <icon src="{_esc(tvg_logo)}" />\n' if tvg_logo else ''
+             yield (
+                 f'  <channel id="{_esc(tvg_id)}">\n'
+                 f'    <display-name>{_esc(name)}</display-name>\n'
+                 f'{icon}'
+                 '  </channel>\n'
+             )
 
         # 2. Output Programmes
         # Optimization: Query only EPG data for the enabled channels using a subquery
@@ -81,27 +226,27 @@ def get_epg_xml():
              Channel.tvg_id != None
         )
 
-        epg_query = EpgData.query.filter(
+        now = datetime.now(timezone.utc)
+        # Plain rows grouped by channel in start order; this is the ix_epg_lookup index order, so no sort
+        epg_query = db.session.query(
+            EpgData.channel_tvg_id, EpgData.start_time, EpgData.end_time, EpgData.title, EpgData.description
+        ).filter(
             EpgData.channel_tvg_id.in_(valid_tvg_ids_subquery),
-            EpgData.end_time > datetime.now(timezone.utc)
-        ).order_by(EpgData.start_time)
+            EpgData.end_time > now
+        ).order_by(EpgData.channel_tvg_id, EpgData.start_time)
 
         # Use yield_per to fetch in chunks to avoid memory overload
-        for prog in epg_query.yield_per(500):
-            channel_id_esc = escape(prog.channel_tvg_id)
-            title_esc = escape(prog.title)
-            
-            # Helper to format time
-            start_str = prog.start_time.strftime('%Y%m%d%H%M%S %z')
-            end_str = prog.end_time.strftime('%Y%m%d%H%M%S %z')
-
-            yield f'  <programme start="{start_str}" stop="{end_str}" channel="{channel_id_esc}">\n'
-            yield f'    <title lang="en">{title_esc}</title>\n'
-            if prog.description:
-                desc_esc = escape(prog.description)
-                yield f'    <desc lang="en">{desc_esc}</desc>\n'
-            yield '  </programme>\n'
+        for channel_tvg_id, programmes in groupby(epg_query.yield_per(1000), key=itemgetter(0)):
+            channel_id_esc = _esc(channel_tvg_id)
+            for _, start_time, end_time, title, description in programmes:
+                desc = f'    <desc lang="en">{_esc(description)}</desc>\n' if description else ''
+                yield (
+                    f'  <programme start="{_fmt_xmltv_time(start_time)}" stop="{_fmt_xmltv_time(end_time)}" channel="{channel_id_esc}">\n'
+                    f'    <title lang="en">{_esc(title)}</title>\n'
+                    f'{desc}'
+                    '  </programme>\n'
+                )
         
         yield '</tv>'
 
-    return Response(stream_with_context(generate()), mimetype='application/xml')
+    return _cached_response('epg', _epg_etag(), generate, {'Content-Type': 'application/xml; charset=utf-8'})
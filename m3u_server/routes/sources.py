@@ -1,10 +1,10 @@
 # m3u_server/routes/sources.py
-import os
-from flask import Blueprint, render_template, request, flash, redirect, url_for, current_app
+from flask import Blueprint, render_template, request, flash, redirect, url_for
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from .. import db
 from ..models import M3uSource
 from ..forms import SourceM3uForm, UpdateIntervalForm
-from ..scheduler_jobs import schedule_source_refresh_job, refresh_single_m3u_source
+from ..scheduler_jobs import schedule_source_refresh_job, unschedule_job, refresh_single_m3u_source
 from .. import scheduler
 
 sources_bp = Blueprint('sources', __name__)
@@ -12,26 +12,6 @@ sources_bp = Blueprint('sources', __name__)
 @sources_bp.route('/')
 def manage_sources():
     """Displays M3U source URLs and allows management."""
-
-    # --- DEBUGGING STEP ---
-    # Log the exact path Flask is checking for the template.
-    template_path = os.path.join(current_app.root_path, 'templates', 'manage_sources.html')
-    current_app.logger.info(f"Attempting to render template. Checking for file at: {template_path}")
-
-    if not os.path.exists(template_path):
-        current_app.logger.error(f"*** TEMPLATE NOT FOUND AT PATH: {template_path} ***")
-        
-        # Also, let's log the contents of the templates directory to see what's there.
-        templates_dir = os.path.join(current_app.root_path, 'templates')
-        try:
-            dir_contents = os.listdir(templates_dir)
-            current_app.logger.info(f"Actual contents of templates directory ('{templates_dir}'): {dir_contents}")
-        except FileNotFoundError:
-            current_app.logger.error(f"The 'templates' directory itself was not found at: {templates_dir}")
-    else:
-        current_app.logger.info("Success! Template file was found at the expected path.")
-    # --- END DEBUGGING STEP ---
-
     sources = M3uSource.query.order_by(M3uSource.id).all()
     interval_form = UpdateIntervalForm()
     return render_template('manage_sources.html', sources=sources, interval_form=interval_form, title="Manage M3U Sources")
@@ -42,13 +22,16 @@ def add_source():
     form = SourceM3uForm()
     if form.validate_on_submit():
         url = form.m3u_url.data
-        if M3uSource.query.filter_by(url=url).first():
+        # One statement: the UNIQUE(url) constraint decides, so concurrent submits can't both insert
+        inserted = db.session.execute(
+            sqlite_insert(M3uSource).values(url=url).on_conflict_do_nothing(index_elements=['url'])
+            .returning(M3uSource.id, M3uSource.refresh_interval_hours)
+        ).first()
+        db.session.commit()
+        if inserted is None:
             flash('Source URL already exists.', 'warning')
         else:
-            new_source = M3uSource(url=url)
-            db.session.add(new_source)
-            db.session.commit()
-            schedule_source_refresh_job(new_source.id, new_source.url, new_source.refresh_interval_hours)
+            schedule_source_refresh_job(inserted.id, url, inserted.refresh_interval_hours)
             flash(f'Source "{url[:50]}..." added and scheduled for daily refresh.', 'success')
         return redirect(url_for('sources.manage_sources'))
     return render_template('source_form.html', form=form, title="Add M3U Source")
@@ -57,8 +40,7 @@ def add_source():
 def delete_source(source_id):
     source = M3uSource.query.get_or_404(source_id)
     job_id = f'm3u_refresh_{source_id}'
-    if scheduler.get_job(job_id):
-        scheduler.remove_job(job_id)
+    unschedule_job(job_id)
     db.session.delete(source)
     db.session.commit()
     flash('Source URL deleted and job unscheduled.', 'success')
@@ -74,8 +56,7 @@ def toggle_source(source_id):
         schedule_source_refresh_job(source.id, source.url, source.refresh_interval_hours)
         flash('Source enabled and job scheduled.', 'success')
     else:
-        if scheduler.get_job(job_id):
-            scheduler.remove_job(job_id)
+        unschedule_job(job_id)
         flash('Source disabled and job unscheduled.', 'warning')
     return redirect(url_for('sources.manage_sources'))
 
@@ -1,66 +1,362 @@
 # m3u_server/scheduler_jobs.py
+import io
 import re
+import queue
+import threading
+import functools
+import gzip
+import hashlib
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError:  # Python < 3.11
+    import sre_parse, sre_constants
 import requests
 import xml.etree.ElementTree as ET
+from contextlib import closing
 from datetime import datetime, timedelta, timezone
 from flask import current_app
-from sqlalchemy.orm import selectinload
-from sqlalchemy import or_
+from apscheduler.jobstores.base import JobLookupError
+from sqlalchemy import delete, exists, insert, literal, select, text
 
 # Import the app factory and extensions from the main package
 from . import db, scheduler, create_app
-from .models import M3uSource, EpgSource, Channel, Url, EpgData, Filter
+from .models import M3uSource, EpgSource, Channel, Url, EpgData, Filter, compile_filter_pattern
+
+# --- Precompiled Patterns ---
+# Every byte except a-z and 0-9, deleted in one bytes.translate pass when the EPG mapper
+# normalizes channel names (non-ASCII characters are dropped by the ASCII encode first).
+_NORMALIZE_DELETE_BYTES = bytes(b for b in range(256) if not (ord('a') <= b <= ord('z') or ord('0') <= b <= ord('9')))
+
+# Byte values allowed in an EXTINF attribute key (e.g. 'tvg-id', 'group_title').
+_ATTR_KEY_CHARS = frozenset(b'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_-')
+_EXTINF_PREFIX_LEN = len(b'#EXTINF:')
+
+# Keeps IN (...) lists well under SQLite's bound-parameter limit.
+IN_CLAUSE_CHUNK_SIZE = 500
+
+# Channels written per M3U refresh transaction. Each commit is a WAL sync, while one
+# transaction per source would hold the write lock past other jobs' 30s busy timeout.
+M3U_CHANNELS_PER_COMMIT = 10000
+
+# --- Job Application ---
+# Jobs reuse one Flask app (and its engine/connection pool) instead of building a new one per run.
+# Per EPG source: the feed's HTTP validators plus a fingerprint of the channels it was mapped
+# against, from the last complete refresh in this process
+_epg_feed_state = {}
+_epg_feed_state_lock = threading.Lock()
+
+_job_app = None
+_job_app_lock = threading.Lock()
+
+def set_job_app(app):
+    """Registers the app whose context scheduled jobs run in."""
+    global _job_app
+    _job_app = app
+
+def get_job_app():
+    """Returns the registered job app, creating one on first use (e.g. when a job is called directly)."""
+    global _job_app
+    with _job_app_lock:
+        if _job_app is None:
+            _job_app = create_app()
+        return _job_app
 
 # --- Helper Functions ---
 
+def chunked(seq, size=IN_CLAUSE_CHUNK_SIZE):
+    """Yields successive slices of `seq` with at most `size` items each."""
+    for i in range(0, len(seq), size):
+        yield seq[i:i + size]
+
+@functools.lru_cache(maxsize=64)
+def _xmltv_timezone(offset_str):
+    """Returns the tzinfo for an XMLTV '+HHMM'/'-HHMM' offset; guides use only a handful of distinct ones."""
+    offset_delta = timedelta(hours=int(offset_str[1:3]), minutes=int(offset_str[3:5]))
+    if offset_str[0] == '-':
+        offset_delta = -offset_delta
+    return timezone(offset_delta)
+
+# Start/stop times repeat across channels (programmes align to the same half hours), so a
+# guide with millions of programmes holds only a few thousand distinct timestamps
+@functools.lru_cache(maxsize=1 << 15)
 def parse_xmltv_datetime(dt_str):
-    """Parses XMLTV timestamp into a timezone-aware datetime object."""
+    """Parses XMLTV timestamp into a timezone-aware datetime object, normalized to UTC."""
     try:
         parts = dt_str.strip().split(' ')
         dt_part = parts[0]
-        dt = datetime.strptime(dt_part, '%Y%m%d%H%M%S')
+        if len(dt_part) == 14 and dt_part.isdigit():
+            # The usual YYYYMMDDHHMMSS form, sliced directly instead of going through strptime
+            dt = datetime(int(dt_part[0:4]), int(dt_part[4:6]), int(dt_part[6:8]),
+                          int(dt_part[8:10]), int(dt_part[10:12]), int(dt_part[12:14]))
+        else:
+            dt = datetime.strptime(dt_part, '%Y%m%d%H%M%S')
         if len(parts) > 1:
-            offset_str = parts[1]
-            offset_hours = int(offset_str[1:3])
-            offset_minutes = int(offset_str[3:5])
-            offset_delta = timedelta(hours=offset_hours, minutes=offset_minutes)
-            if offset_str[0] == '-':
-                offset_delta = -offset_delta
-            tz = timezone(offset_delta)
-            return dt.replace(tzinfo=tz)
+            tz = _xmltv_timezone(parts[1])
+            # Stored as UTC: SQLite keeps only the wall time, so the offset must be applied here
+            return dt.replace(tzinfo=tz).astimezone(timezone.utc)
         else:
             return dt.replace(tzinfo=timezone.utc)
     except (ValueError, IndexError) as e:
         print(f"ERROR: Failed to parse XMLTV datetime string '{dt_str}': {e}")
         return None
 
+def parse_extinf(line_bytes):
+    """
+    Parses a raw '#EXTINF:' line into a dict of normalized attributes plus 'display_name'.
+    Uses a plain find/slice scanner instead of regex; only the captured values are decoded.
+    Returns None for malformed lines.
+    """
+    pos = _EXTINF_PREFIX_LEN
+    line_len = len(line_bytes)
+    if pos < line_len and line_bytes[pos] == 0x2D:  # '-'
+        pos += 1
+    digits_start = pos
+    while pos < line_len and 0x30 <= line_bytes[pos] <= 0x39:
+        pos += 1
+    if pos == digits_start:
+        return None
+
+    # The display name follows the last comma; everything before it holds the attributes.
+    comma = line_bytes.rfind(b',', pos)
+    if comma == -1:
+        return None
+    attributes_part = line_bytes[pos:comma]
+
+    attrs = {}
+    scan = 0
+    while True:
+        eq = attributes_part.find(b'="', scan)
+        if eq == -1:
+            break
+        value_end = attributes_part.find(b'"', eq + 2)
+        if value_end == -1:
+            break
+        key_start = eq
+        while key_start > scan and attributes_part[key_start - 1] in _ATTR_KEY_CHARS:
+            key_start -= 1
+        if key_start == eq:
+            scan = eq + 1
+            continue
+        key = attributes_part[key_start:eq].decode('ascii').lower().replace('-', '_')
+        attrs[key] = attributes_part[eq + 2:value_end].decode('utf-8', 'ignore')
+        scan = value_end + 1
+
+    attrs['display_name'] = line_bytes[comma + 1:].decode('utf-8', 'ignore').strip()
+    return attrs
+
+class ChunkStream(io.RawIOBase):
+    """Adapts an iterator of byte chunks (e.g. response.iter_content) to a readable raw stream."""
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._pending = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._pending:
+            self._pending = next(self._chunks, None)
+            if self._pending is None:
+                self._pending = b''
+                return 0
+        size = min(len(buffer), len(self._pending))
+        buffer[:size] = self._pending[:size]
+        self._pending = self._pending[size:]
+        return size
+
+def open_download_stream(response, chunk_size=1 << 16):
+    """
+    Returns a file-like reader over a streamed response body. HTTP content-encoding is decoded,
+    and gzipped files (e.g. 'guide.xml.gz', often served without a Content-Encoding header)
+    are recognized by their magic bytes and decompressed on the fly.
+    """
+    stream = io.BufferedReader(ChunkStream(response.iter_content(chunk_size=chunk_size)), buffer_size=chunk_size)
+    if stream.peek(2)[:2] == b'\x1f\x8b':
+        return gzip.GzipFile(fileobj=stream)
+    return stream
+
+def iter_download_lines(response, chunk_size=1 << 20, max_buffered_chunks=8):
+    """
+    Yields raw lines from a streamed response. A background thread keeps downloading
+    into a bounded queue, so network time overlaps with whatever the consumer does per line.
+    """
+    chunks = queue.Queue(maxsize=max_buffered_chunks)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.5)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def produce():
+        try:
+            stream = open_download_stream(response)
+            for chunk in iter(lambda: stream.read(chunk_size), b''):
+                if not put(chunk):
+                    return
+            put(None)
+        except Exception as e:
+            # Network errors and corrupt/truncated gzip bodies alike are re-raised in the consumer
+            put(e)
+
+    threading.Thread(target=produce, name='m3u-download', daemon=True).start()
+    try:
+        remainder = b''
+        while True:
+            item = chunks.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+            data = remainder + item
+            # Only split up to the last line break; the tail may continue in the next chunk.
+            cut = max(data.rfind(b'\n'), data.rfind(b'\r')) + 1
+            remainder = data[cut:]
+            yield from data[:cut].splitlines()
+        if remainder:
+            yield remainder
+    finally:
+        stop.set()
+
+def parse_m3u_lines(lines):
+    """
+    Groups playlist entries by tvg-id (or name when missing).
+    Returns {channel_key: {'attrs': dict, 'urls': set}}.
+    """
+    parsed_channels = {}
+    current_extinf_data = None
+    for line_bytes in lines:
+        line_bytes = line_bytes.strip()
+        if not line_bytes: continue
+
+        if line_bytes.startswith(b'#EXTINF:'):
+            current_extinf_data = parse_extinf(line_bytes)
+            continue
+
+        if current_extinf_data and not line_bytes.startswith(b'#'):
+            stream_url = line_bytes.decode('utf-8', 'ignore')
+            tvg_id = current_extinf_data.get('tvg_id')
+            channel_name = current_extinf_data.get('tvg_name') or current_extinf_data.get('display_name')
+            
+            if not channel_name:
+                current_extinf_data = None
+                continue
+
+            channel_key = tvg_id if tvg_id else channel_name
+            
+            if channel_key not in parsed_channels:
+                parsed_channels[channel_key] = {'attrs': current_extinf_data, 'urls': set()}
+            
+            parsed_channels[channel_key]['urls'].add(stream_url)
+            current_extinf_data = None
+    return parsed_channels
+
+class FilterPatternList:
+    """Matches filter patterns one at a time; used when they can't be fused into one regex."""
+    def __init__(self, patterns):
+        self.compiled = []
+        for pattern in patterns:
+            try:
+                self.compiled.append(compile_filter_pattern(pattern))
+            except re.error as e:
+                # Patterns are validated when added through the UI; skip any stored some other way
+                current_app.logger.warning(f"[Sync-States] Skipping invalid filter pattern '{pattern}': {e}")
+
+    def search(self, text):
+        for pattern in self.compiled:
+            match = pattern.search(text)
+            if match:
+                return match
+        return None
+
+def has_group_references(pattern):
+    """
+    True when a pattern refers back to a group (\\1, (?P=name) or (?(1)...)). Plain capturing
+    groups like '(HD|SD)' are not references and can be fused safely.
+    """
+    stack = [sre_parse.parse(pattern)]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, sre_parse.SubPattern):
+            for op, av in node:
+                if op in (sre_constants.GROUPREF, sre_constants.GROUPREF_EXISTS):
+                    return True
+                stack.append(av)
+        elif isinstance(node, (tuple, list)):
+            stack.extend(node)
+    return False
+
+@functools.lru_cache(maxsize=32)
+def compile_filter_union(patterns):
+    """
+    Fuses a tuple of filter patterns into a single case-insensitive alternation so each
+    name is scanned once instead of once per filter. Cached per pattern set, so repeated
+    syncs with unchanged filters reuse the compiled union. Returns None when empty.
+    """
+    if not patterns:
+        return None
+    try:
+        # Patterns that refer back to a group are matched one by one: inside the union a
+        # reference like \1 would point at another pattern's group and match the wrong text
+        if any(has_group_references(pattern) for pattern in patterns):
+            return FilterPatternList(patterns)
+        return re.compile('|'.join(f'(?:{pattern})' for pattern in patterns), re.IGNORECASE)
+    except re.error:
+        # Patterns that are valid alone can still break the union, e.g. an inline flag
+        # like "(?i)" that must sit at the start of the whole expression
+        return FilterPatternList(patterns)
+
+@functools.lru_cache(maxsize=100_000)
+def matches_filter_union(filter_union, text):
+    """
+    Memoized filter check. Category and channel names repeat heavily across sources and
+    sync runs; the compiled union is part of the key, so changed filters never hit stale entries.
+    """
+    return filter_union.search(text) is not None
+
+def channel_mapping_fingerprint(channels):
+    """Digest of the channel fields EPG mapping reads; a changed channel list means the feed must be remapped."""
+    digest = hashlib.sha1()
+    for channel in channels:
+        digest.update(f"{channel['id']}\x1f{channel['name']}\x1f{channel['tvg_id']}\x1f{channel['tvg_logo']}\x1e".encode('utf-8'))
+    return digest.hexdigest()
+
+# Sized above typical channel counts: each refresh walks every name in the same order, and an LRU
+# smaller than that working set would evict every entry before it is reused
+@functools.lru_cache(maxsize=1 << 16)
 def normalize_name(name):
-    """Creates a simplified version of a name for fuzzy matching."""
+    """Creates a simplified version of a name for fuzzy matching. Cached: every EPG refresh re-normalizes the same names."""
     if not name:
         return ""
-    return re.sub(r'[^a-z0-9]', '', name.lower())
+    return name.lower().encode('ascii', 'ignore').translate(None, _NORMALIZE_DELETE_BYTES).decode('ascii')
 
 # --- Job Scheduling Helpers ---
 
-def schedule_all_source_refreshes():
-    """Schedules jobs for all enabled M3U sources."""
-    try:
-        sources = M3uSource.query.filter_by(enabled=True).all()
-        for source in sources:
-            schedule_source_refresh_job(source.id, source.url, source.refresh_interval_hours)
-        current_app.logger.info(f"Scheduled refresh jobs for {len(sources)} M3U sources.")
-    except Exception as e:
-        current_app.logger.error(f"Error scheduling M3U source jobs: {e}", exc_info=True)
-
-def schedule_all_epg_refreshes():
-    """Schedules jobs for all enabled EPG sources."""
+def schedule_all_refreshes():
+    """
+    Schedules refresh jobs for all enabled M3U and EPG sources.
+    Reads only (id, url, interval) per source. Called before scheduler.start(), where add_job
+    only queues the job; APScheduler writes the whole queue to the jobstore when it starts.
+    """
     try:
-        epg_sources = EpgSource.query.filter_by(enabled=True).all()
-        for epg_source in epg_sources:
-            schedule_epg_refresh_job(epg_source.id, epg_source.url, epg_source.refresh_interval_hours)
-        current_app.logger.info(f"Scheduled refresh jobs for {len(epg_sources)} EPG sources.")
+        sources = db.session.query(
+            M3uSource.id, M3uSource.url, M3uSource.refresh_interval_hours
+        ).filter(M3uSource.enabled == True).all()
+        epg_sources = db.session.query(
+            EpgSource.id, EpgSource.url, EpgSource.refresh_interval_hours
+        ).filter(EpgSource.enabled == True).all()
+
+        for source_id, source_url, interval_hours in sources:
+            schedule_source_refresh_job(source_id, source_url, interval_hours)
+        for epg_id, epg_url, interval_hours in epg_sources:
+            schedule_epg_refresh_job(epg_id, epg_url, interval_hours)
+        current_app.logger.info(f"Scheduled refresh jobs for {len(sources)} M3U sources and {len(epg_sources)} EPG sources.")
     except Exception as e:
-        current_app.logger.error(f"Error scheduling EPG source jobs: {e}", exc_info=True)
+        current_app.logger.error(f"Error scheduling source refresh jobs: {e}", exc_info=True)
 
 def schedule_source_refresh_job(source_id, source_url, interval_hours):
     job_id = f'm3u_refresh_{source_id}'
@@ -80,6 +376,13 @@ def schedule_epg_refresh_job(epg_id, epg_url, interval_hours):
         name=f'Refresh EPG {epg_id}', replace_existing=True
     )
 
+def unschedule_job(job_id):
+    """Removes a job if it is scheduled; a single jobstore call instead of get_job + remove_job."""
+    try:
+        scheduler.remove_job(job_id)
+    except JobLookupError:
+        pass
+
 # --- Core Logic and Jobs ---
 
 def _synchronize_channel_states_logic():
@@ -94,31 +397,36 @@ def _synchronize_channel_states_logic():
     
     try:
         # Rule 1: Get all active regex filters
-        active_regex_filters = Filter.query.filter_by(enabled=True).all()
-        compiled_filters = [re.compile(f.pattern, re.IGNORECASE) for f in active_regex_filters]
-        current_app.logger.info(f"[Sync-States] Found {len(compiled_filters)} active regex filters.")
+        active_patterns = tuple(db.session.execute(
+            select(Filter.pattern).where(Filter.enabled == True).order_by(Filter.id)
+        ).scalars())
+        filter_union = compile_filter_union(active_patterns)
+        current_app.logger.info(f"[Sync-States] Found {len(active_patterns)} active regex filters.")
 
         # Rule 2: Check if the "no EPG" rule is active and get relevant data
         no_epg_rule_active = current_app.config.get('DISABLE_CHANNELS_WITHOUT_EPG', False)
-        channels_with_epg = set()
-        if no_epg_rule_active:
-            channels_with_epg = {row[0] for row in db.session.query(EpgData.channel_tvg_id).distinct().all() if row[0]}
-            current_app.logger.info(f"[Sync-States] 'No EPG' rule is active. Found {len(channels_with_epg)} channels with EPG data.")
+        # Per-channel EXISTS probe on ix_epg_lookup, instead of reading every distinct tvg_id out of epg_data
+        has_epg = exists().where(EpgData.channel_tvg_id == Channel.tvg_id) if no_epg_rule_active else literal(True)
 
-        all_channels = Channel.query.all()
+        # Only the columns the rules look at, as plain rows; the changes go out as batched UPDATEs
+        all_channels = db.session.execute(
+            select(Channel.id, Channel.name, Channel.category, Channel.tvg_id, Channel.enabled, has_epg.label('has_epg'))
+        ).all()
+        if no_epg_rule_active:
+            current_app.logger.info(f"[Sync-States] 'No EPG' rule is active. Found {sum(1 for ch in all_channels if ch.tvg_id and ch.has_epg)} channels with EPG data.")
         channels_to_disable = []
         channels_to_enable = []
         log_counter = 0
         
         for channel in all_channels:
             # Check if channel should be blocked by a regex filter
-            is_blocked_by_regex = any(p.search(text) for p in compiled_filters for text in [channel.name, channel.category] if text)
+            is_blocked_by_regex = filter_union is not None and any(matches_filter_union(filter_union, text) for text in (channel.name, channel.category) if text)
             
             # Check if channel should be blocked by the "no EPG" rule
             is_blocked_by_no_epg = False
             if no_epg_rule_active:
-                # A channel is blocked if it has no tvg_id OR its tvg_id is not in the set of channels with EPG data.
-                if not channel.tvg_id or channel.tvg_id not in channels_with_epg:
+                # A channel is blocked if it has no tvg_id OR there is no EPG data for its tvg_id.
+                if not channel.tvg_id or not channel.has_epg:
                     is_blocked_by_no_epg = True
             
             # Determine the final state
@@ -137,11 +445,13 @@ def _synchronize_channel_states_logic():
         
         if channels_to_disable:
             current_app.logger.info(f"[Sync-States] Disabling {len(channels_to_disable)} channels.")
-            db.session.query(Channel).filter(Channel.id.in_(channels_to_disable)).update({'enabled': False}, synchronize_session=False)
+            for id_chunk in chunked(channels_to_disable):
+                db.session.query(Channel).filter(Channel.id.in_(id_chunk)).update({'enabled': False}, synchronize_session=False)
 
         if channels_to_enable:
             current_app.logger.info(f"[Sync-States] Enabling {len(channels_to_enable)} channels.")
-            db.session.query(Channel).filter(Channel.id.in_(channels_to_enable)).update({'enabled': True}, synchronize_session=False)
+            for id_chunk in chunked(channels_to_enable):
+                db.session.query(Channel).filter(Channel.id.in_(id_chunk)).update({'enabled': True}, synchronize_session=False)
 
         if channels_to_disable or channels_to_enable:
             db.session.commit()
@@ -155,83 +465,67 @@ def _synchronize_channel_states_logic():
 
 def synchronize_channel_states():
     """The main job function that creates an app context and runs the sync logic."""
-    app = create_app()
+    app = get_job_app()
     with app.app_context():
         _synchronize_channel_states_logic()
 
 def refresh_single_m3u_source(source_id, source_url):
     """Fetches and processes a single M3U source URL efficiently."""
-    app = create_app()
+    app = get_job_app()
     with app.app_context():
         current_app.logger.info(f"[M3U-Refresh:{source_id}] Starting process for: {source_url}")
         start_time = datetime.now(timezone.utc)
 
+        parsed_channels = None
         try:
             headers = {'User-Agent': 'M3U-Server/1.0'}
-            response = requests.get(source_url, timeout=60, headers=headers)
-            response.raise_for_status()
-            m3u_content = response.text
-        except requests.RequestException as e:
+            with requests.get(source_url, timeout=60, headers=headers, stream=True) as response:
+                response.raise_for_status()
+                # Lines are parsed as they arrive while the rest of the body keeps downloading.
+                with closing(iter_download_lines(response)) as lines:
+                    first_line = next(lines, b'')
+                    if first_line.strip().startswith(b'#EXTM3U'):
+                        parsed_channels = parse_m3u_lines(lines)
+        except (requests.RequestException, OSError, EOFError) as e:
+            # OSError/EOFError: a corrupt or truncated gzip body, raised by the decompressing
+            # stream and handed over from the download thread
+            db.session.rollback()
             current_app.logger.error(f"[M3U-Refresh:{source_id}] Download failed: {e}")
             return
 
-        lines = m3u_content.splitlines()
-        if not lines or not lines[0].strip().startswith('#EXTM3U'):
+        if parsed_channels is None:
             current_app.logger.warning(f"[M3U-Refresh:{source_id}] Invalid M3U header.")
             return
 
-        parsed_channels = {}
-        current_extinf_data = None
-        for line in lines:
-            line = line.strip()
-            if not line: continue
-
-            if line.startswith('#EXTINF:'):
-                match = re.match(r'#EXTINF:-?\d+\s*(.*),(.*)', line)
-                if match:
-                    attributes_str, display_name = match.groups()
-                    attrs = dict(re.findall(r'([a-zA-Z0-9_-]+)="([^"]*)"', attributes_str))
-                    attrs = {k.lower().replace('-', '_'): v for k, v in attrs.items()}
-                    attrs['display_name'] = display_name.strip()
-                    current_extinf_data = attrs
-                else:
-                    current_extinf_data = None
-                continue
-
-            if current_extinf_data and not line.startswith('#'):
-                stream_url = line
-                tvg_id = current_extinf_data.get('tvg_id')
-                channel_name = current_extinf_data.get('tvg_name') or current_extinf_data.get('display_name')
-                
-                if not channel_name:
-                    current_extinf_data = None
-                    continue
-
-                channel_key = tvg_id if tvg_id else channel_name
-                
-                if channel_key not in parsed_channels:
-                    parsed_channels[channel_key] = {'attrs': current_extinf_data, 'urls': set()}
-                
-                parsed_channels[channel_key]['urls'].add(stream_url)
-                current_extinf_data = None
-        
         current_app.logger.info(f"[M3U-Refresh:{source_id}] Parsed {len(parsed_channels)} unique channels.")
 
+        # Load every channel and URL once as plain rows; batches resolve matches in memory.
+        channels_by_tvg_id = {}
+        channels_by_name = {}
+        channel_rows = db.session.query(
+            Channel.id, Channel.name, Channel.tvg_id, Channel.tvg_logo, Channel.category, Channel.channel_num
+        ).yield_per(10000)
+        for row in channel_rows:
+            channel = row._asdict()
+            if channel['tvg_id']: channels_by_tvg_id[channel['tvg_id']] = channel
+            channels_by_name[channel['name']] = channel
+
+        existing_urls_map = {}
+        for url_id, channel_id, url_str in db.session.query(Url.id, Url.channel_id, Url.url).yield_per(10000):
+            existing_urls_map.setdefault(channel_id, {})[url_str] = url_id
+
         all_channel_keys = list(parsed_channels.keys())
         batch_size = 500
+        channels_since_commit = 0
         for i in range(0, len(all_channel_keys), batch_size):
             batch_keys = all_channel_keys[i:i + batch_size]
-            
-            possible_matches = db.session.query(Channel).filter(
-                or_(Channel.tvg_id.in_(batch_keys), Channel.name.in_(batch_keys))
-            ).options(selectinload(Channel.urls)).all()
-
-            channels_by_tvg_id = {ch.tvg_id: ch for ch in possible_matches if ch.tvg_id}
-            channels_by_name = {ch.name: ch for ch in possible_matches}
-
-            for channel_key, m3u_item in parsed_channels.items():
-                if channel_key not in batch_keys: continue
+            new_channels = []
+            touched_channels = {}
+            updated_url_ids = []
+            urls_to_add = []
 
+            for channel_key in batch_keys:
+                m3u_item = parsed_channels[channel_key]
                 attrs = m3u_item['attrs']
                 urls = m3u_item['urls']
                 
@@ -246,38 +540,66 @@ def refresh_single_m3u_source(source_id, source_url):
 
                 channel = None
                 if tvg_id: channel = channels_by_tvg_id.get(tvg_id)
-                if not channel: channel = channels_by_name.get(channel_name)
+                if not channel:
+                    channel = channels_by_name.get(channel_name)
+                    # A same-named channel carrying a different tvg_id is another channel
+                    if channel and tvg_id and channel['tvg_id'] and channel['tvg_id'] != tvg_id:
+                        channel = None
 
                 if not channel:
-                    channel = Channel(
-                        tvg_id=tvg_id,
-                        name=channel_name,
-                        tvg_name=attrs.get('tvg_name', channel_name),
-                        tvg_logo=logo_url,
-                        category=category,
-                        channel_num=channel_num
-                    )
-                    db.session.add(channel)
+                    channel = {
+                        'id': None,
+                        'tvg_id': tvg_id,
+                        'name': channel_name,
+                        'tvg_logo': logo_url,
+                        'category': category,
+                        'channel_num': channel_num,
+                    }
+                    new_channels.append((channel, attrs.get('tvg_name', channel_name)))
                     if tvg_id: channels_by_tvg_id[tvg_id] = channel
                     channels_by_name[channel_name] = channel
-                    db.session.flush()
                 else:
-                    channel.name = channel_name
-                    if logo_url: channel.tvg_logo = logo_url
-                    if category: channel.category = category
-                    if channel_num is not None: channel.channel_num = channel_num
-                    if tvg_id and not channel.tvg_id: channel.tvg_id = tvg_id
-
-                channel.last_seen = start_time
-                existing_urls = {u.url for u in channel.urls}
-                for url_str in urls:
-                    if url_str not in existing_urls:
-                        db.session.add(Url(url=url_str, channel_id=channel.id, last_seen=start_time))
-                    else:
-                        for u in channel.urls:
-                            if u.url == url_str: u.last_seen = start_time
-            
-            db.session.commit()
+                    channel['name'] = channel_name
+                    if logo_url: channel['tvg_logo'] = logo_url
+                    if category: channel['category'] = category
+                    if channel_num is not None: channel['channel_num'] = channel_num
+                    if tvg_id and not channel['tvg_id']: channel['tvg_id'] = tvg_id
+                    if channel['id'] is not None: touched_channels[channel['id']] = channel
+
+                existing_urls = existing_urls_map.get(channel['id'], {})
+                urls_to_add.extend((channel, url_str) for url_str in urls - existing_urls.keys())
+                updated_url_ids.extend(existing_urls[url_str] for url_str in urls & existing_urls.keys())
+
+            if new_channels:
+                # INSERT ... RETURNING hands back the new ids in parameter order; no ORM flush needed.
+                new_channel_ids = db.session.execute(
+                    insert(Channel).returning(Channel.id, sort_by_parameter_order=True),
+                    [
+                        {**{k: v for k, v in channel.items() if k != 'id'}, 'tvg_name': tvg_name, 'last_seen': start_time}
+                        for channel, tvg_name in new_channels
+                    ]
+                ).scalars().all()
+                for (channel, _), channel_id in zip(new_channels, new_channel_ids):
+                    channel['id'] = channel_id
+
+            if touched_channels:
+                db.session.bulk_update_mappings(Channel, [
+                    {**channel, 'last_seen': start_time} for channel in touched_channels.values()
+                ])
+            url_rows = [
+                {'channel_id': channel['id'], 'url': url_str, 'last_seen': start_time}
+                for channel, url_str in urls_to_add
+            ]
+            for row_chunk in chunked(url_rows, 1000):
+                db.session.execute(Url.__table__.insert(), row_chunk)
+            for id_chunk in chunked(updated_url_ids):
+                db.session.query(Url).filter(Url.id.in_(id_chunk)).update({'last_seen': start_time}, synchronize_session=False)
+            # Batches bound memory; commits are spaced further apart
+            channels_since_commit += len(batch_keys)
+            if channels_since_commit >= M3U_CHANNELS_PER_COMMIT:
+                db.session.commit()
+                channels_since_commit = 0
+        db.session.commit()
             
         source = M3uSource.query.get(source_id)
         if source:
@@ -290,57 +612,107 @@ def refresh_single_m3u_source(source_id, source_url):
 
 def refresh_single_epg_source(epg_id, epg_url):
     """Fetches and processes a single XMLTV EPG source, mapping EPG data and updating channel info."""
-    app = create_app()
+    app = get_job_app()
     with app.app_context():
         current_app.logger.info(f"[EPG-Refresh:{epg_id}] Starting process for: {epg_url}")
         start_time = datetime.now(timezone.utc)
 
         try:
-            headers = {'User-Agent': 'M3U-Server/1.0'}
-            response = requests.get(epg_url, timeout=300, headers=headers)
-            response.raise_for_status()
-            xml_content = response.content
-        except requests.RequestException as e:
-            current_app.logger.error(f"[EPG-Refresh:{epg_id}] Download failed: {e}")
-            return
-
-        try:
-            root = ET.fromstring(xml_content)
-            
-            all_db_channels = Channel.query.all()
-            db_channels_by_tvg_id = {c.tvg_id.lower(): c for c in all_db_channels if c.tvg_id}
-            db_channels_by_norm_name = {normalize_name(c.name): c for c in all_db_channels}
+            # Plain (id, name, tvg_id, tvg_logo) rows as dicts; matched channels are updated in one batch
+            all_db_channels = [row._asdict() for row in db.session.execute(
+                select(Channel.id, Channel.name, Channel.tvg_id, Channel.tvg_logo).order_by(Channel.id)
+            )]
             
             epg_to_db_channel_map = {}
-            channels_to_update = []
+            channels_to_update = {}
+            new_programs = []
 
-            for epg_channel_node in root.findall('channel'):
-                epg_id_attr = epg_channel_node.attrib.get('id')
-                if not epg_id_attr: continue
+            headers = {'User-Agent': 'M3U-Server/1.0'}
+            # Conditional request: if neither the feed nor the channels changed since the last
+            # complete refresh, a 304 lets us skip the download and the parse entirely
+            with _epg_feed_state_lock:
+                feed_state = _epg_feed_state.get(epg_id)
+            if feed_state and feed_state['url'] == epg_url and feed_state['fingerprint'] == channel_mapping_fingerprint(all_db_channels):
+                if feed_state['etag']: headers['If-None-Match'] = feed_state['etag']
+                if feed_state['last_modified']: headers['If-Modified-Since'] = feed_state['last_modified']
+
+            with requests.get(epg_url, timeout=300, headers=headers, stream=True) as response:
+                response.raise_for_status()
+                if response.status_code == 304:
+                    epg_source = EpgSource.query.get(epg_id)
+                    if epg_source:
+                        epg_source.last_checked = start_time
+                        db.session.commit()
+                    current_app.logger.info(f"[EPG-Refresh:{epg_id}] Feed not modified since the last refresh; skipping.")
+                    return
+                validators = {'etag': response.headers.get('ETag'), 'last_modified': response.headers.get('Last-Modified')}
+                # Lookup maps are built only once there is a guide to map, not for a 304
+                db_channels_by_tvg_id = {c['tvg_id'].lower(): c for c in all_db_channels if c['tvg_id']}
+                db_channels_by_norm_name = {normalize_name(c['name']): c for c in all_db_channels}
+                # Elements are handled as the parser completes them and then dropped from the tree,
+                # so the whole guide is never held as a DOM. XMLTV lists every <channel> before the
+                # programmes, so the channel map is complete by the time programmes arrive.
+                root = None
+                for event, elem in ET.iterparse(open_download_stream(response), events=('start', 'end')):
+                    if event == 'start':
+                        if root is None:
+                            root = elem
+                        continue
+
+                    if elem.tag == 'channel':
+                        epg_channel_node = elem
+                        epg_id_attr = epg_channel_node.attrib.get('id')
+                        if epg_id_attr:
+                            display_name_node = epg_channel_node.find('display-name')
+                            epg_display_name = display_name_node.text if display_name_node is not None else ''
+                            
+                            icon_node = epg_channel_node.find('icon')
+                            epg_logo_url = icon_node.attrib.get('src') if icon_node is not None else None
+
+                            matched_channel = db_channels_by_tvg_id.get(epg_id_attr.lower())
+                            if not matched_channel and epg_display_name:
+                                matched_channel = db_channels_by_norm_name.get(normalize_name(epg_display_name))
+
+                            if matched_channel:
+                                epg_to_db_channel_map[epg_id_attr] = matched_channel
+                                updated = False
+                                if not matched_channel['tvg_id']:
+                                    matched_channel['tvg_id'] = epg_id_attr
+                                    updated = True
+                                if epg_logo_url and not matched_channel['tvg_logo']:
+                                    matched_channel['tvg_logo'] = epg_logo_url
+                                    updated = True
+                                if updated:
+                                    channels_to_update[matched_channel['id']] = matched_channel
+
+                    elif elem.tag == 'programme':
+                        prog_node = elem
+                        db_channel = epg_to_db_channel_map.get(prog_node.attrib.get('channel'))
+                        if db_channel and db_channel['tvg_id']:
+                            start = parse_xmltv_datetime(prog_node.attrib.get('start'))
+                            stop = parse_xmltv_datetime(prog_node.attrib.get('stop'))
+                            if start and stop and stop >= start_time:
+                                title_node = prog_node.find('title')
+                                desc_node = prog_node.find('desc')
+                                title = title_node.text if title_node is not None else 'No Title'
+                                description = desc_node.text if desc_node is not None else None
+                                
+                                # Plain row dicts for a Core executemany; no EpgData objects or ORM flush
+                                new_programs.append({
+                                    'channel_tvg_id': db_channel['tvg_id'], 'title': title,
+                                    'start_time': start, 'end_time': stop, 'description': description
+                                })
+                    else:
+                        continue
 
-                display_name_node = epg_channel_node.find('display-name')
-                epg_display_name = display_name_node.text if display_name_node is not None else ''
-                
-                icon_node = epg_channel_node.find('icon')
-                epg_logo_url = icon_node.attrib.get('src') if icon_node is not None else None
-
-                matched_channel = db_channels_by_tvg_id.get(epg_id_attr.lower())
-                if not matched_channel and epg_display_name:
-                    matched_channel = db_channels_by_norm_name.get(normalize_name(epg_display_name))
-
-                if matched_channel:
-                    epg_to_db_channel_map[epg_id_attr] = matched_channel
-                    updated = False
-                    if not matched_channel.tvg_id:
-                        matched_channel.tvg_id = epg_id_attr
-                        updated = True
-                    if epg_logo_url and not matched_channel.tvg_logo:
-                        matched_channel.tvg_logo = epg_logo_url
-                        updated = True
-                    if updated:
-                        channels_to_update.append(matched_channel)
+                    # Done with this top-level element: release it and its children
+                    root.clear()
 
             if channels_to_update:
+                db.session.bulk_update_mappings(Channel, [
+                    {'id': channel['id'], 'tvg_id': channel['tvg_id'], 'tvg_logo': channel['tvg_logo']}
+                    for channel in channels_to_update.values()
+                ])
                 db.session.commit()
                 current_app.logger.info(f"[EPG-Refresh:{epg_id}] Updated {len(channels_to_update)} channels with info from EPG.")
 
@@ -348,29 +720,20 @@ def refresh_single_epg_source(epg_id, epg_url):
                 current_app.logger.warning(f"[EPG-Refresh:{epg_id}] No channels were mapped. Aborting programme data update.")
                 return
 
-            mapped_db_tvg_ids = {ch.tvg_id for ch in epg_to_db_channel_map.values() if ch.tvg_id}
-            db.session.query(EpgData).filter(EpgData.channel_tvg_id.in_(mapped_db_tvg_ids)).delete(synchronize_session=False)
-
-            new_programs = []
-            for prog_node in root.findall('programme'):
-                prog_channel_id = prog_node.attrib.get('channel')
-                db_channel = epg_to_db_channel_map.get(prog_channel_id)
-                if not db_channel or not db_channel.tvg_id: continue
-
-                start = parse_xmltv_datetime(prog_node.attrib.get('start'))
-                stop = parse_xmltv_datetime(prog_node.attrib.get('stop'))
-                if not start or not stop or stop < start_time: continue
+            # Old programmes are replaced only once the whole guide has been read, keeping the write short
+            mapped_db_tvg_ids = sorted({ch['tvg_id'] for ch in epg_to_db_channel_map.values() if ch['tvg_id']})
+            # The ids are staged in a per-connection temp table (in memory, see temp_store) so one
+            # DELETE covers every mapped channel, with no IN list to split under the parameter limit
+            connection = db.session.connection()
+            connection.execute(text("CREATE TEMP TABLE IF NOT EXISTS epg_refresh_tvg_ids (tvg_id TEXT PRIMARY KEY)"))
+            connection.execute(text("DELETE FROM epg_refresh_tvg_ids"))
+            connection.execute(text("INSERT INTO epg_refresh_tvg_ids (tvg_id) VALUES (:tvg_id)"),
+                               [{'tvg_id': tvg_id} for tvg_id in mapped_db_tvg_ids])
+            connection.execute(text("DELETE FROM epg_data WHERE channel_tvg_id IN (SELECT tvg_id FROM epg_refresh_tvg_ids)"))
 
-                title = (prog_node.find('title').text if prog_node.find('title') is not None else 'No Title')
-                description = (prog_node.find('desc').text if prog_node.find('desc') is not None else None)
-                
-                new_programs.append(EpgData(
-                    channel_tvg_id=db_channel.tvg_id, title=title,
-                    start_time=start, end_time=stop, description=description
-                ))
-            
             if new_programs:
-                db.session.bulk_save_objects(new_programs)
+                for row_chunk in chunked(new_programs, 1000):
+                    db.session.execute(EpgData.__table__.insert(), row_chunk)
                 db.session.commit()
                 current_app.logger.info(f"[EPG-Refresh:{epg_id}] Ingested {len(new_programs)} new EPG entries.")
 
@@ -378,10 +741,18 @@ def refresh_single_epg_source(epg_id, epg_url):
             if epg_source:
                 epg_source.last_checked = start_time
                 db.session.commit()
+
+            # The channel dicts now carry this refresh's own tvg_id/logo updates
+            with _epg_feed_state_lock:
+                _epg_feed_state[epg_id] = {'url': epg_url, 'fingerprint': channel_mapping_fingerprint(all_db_channels), **validators}
             
             current_app.logger.info(f"[EPG-Refresh:{epg_id}] Process finished. Now running channel state synchronization.")
             _synchronize_channel_states_logic()
 
+        except (requests.RequestException, OSError, EOFError) as e:
+            # OSError/EOFError: a corrupt or truncated gzip body
+            db.session.rollback()
+            current_app.logger.error(f"[EPG-Refresh:{epg_id}] Download failed: {e}")
         except Exception as e:
             db.session.rollback()
             current_app.logger.error(f"[EPG-Refresh:{epg_id}] An unexpected error occurred: {e}", exc_info=True)
@@ -389,18 +760,21 @@ def refresh_single_epg_source(epg_id, epg_url):
 
 def scheduled_cleanup_job():
     """Scheduled task to remove old channels, URLs, and EPG data."""
-    app = create_app()
+    app = get_job_app()
     with app.app_context():
         current_app.logger.info("[Cleanup-Job] Starting daily cleanup...")
         
         channel_cutoff = datetime.now(timezone.utc) - timedelta(days=current_app.config.get('CHANNEL_DATA_RETENTION_DAYS', 3))
-        Url.query.filter(Url.last_seen < channel_cutoff).delete()
+        db.session.execute(delete(Url).where(Url.last_seen < channel_cutoff))
         
-        orphan_channels_query = db.session.query(Channel.id).outerjoin(Url).filter(Url.id == None, Channel.last_seen < channel_cutoff)
-        Channel.query.filter(Channel.id.in_(orphan_channels_query)).delete(synchronize_session=False)
+        # One DELETE with a correlated NOT EXISTS; each probe is a lookup on the urls.channel_id index
+        db.session.execute(delete(Channel).where(
+            Channel.last_seen < channel_cutoff,
+            ~exists().where(Url.channel_id == Channel.id)
+        ))
         
         epg_cutoff = datetime.now(timezone.utc) - timedelta(hours=current_app.config.get('EPG_DATA_RETENTION_HOURS', 72))
-        EpgData.query.filter(EpgData.end_time < epg_cutoff).delete()
+        db.session.execute(delete(EpgData).where(EpgData.end_time < epg_cutoff))
         
         db.session.commit()
         current_app.logger.info("[Cleanup-Job] Finished.")
@@ -0,0 +1,48 @@
+# run_scheduler.py
+import os
+import sys
+import signal
+import threading
+from pathlib import Path
+
+# Add the project root to the Python path to allow for package imports
+project_root = Path(__file__).parent
+sys.path.insert(0, str(project_root))
+
+# This process is the one that runs the jobs, whatever the web processes are configured with
+os.environ['RUN_SCHEDULER'] = 'true'
+os.environ['EXTERNAL_SCHEDULER'] = 'false'
+
+from m3u_server import create_app, scheduler
+
+def poll_job_store():
+    """Does nothing; each run makes the scheduler re-read the shared job store for new jobs."""
+
+def run():
+    """
+    Runs the background refresh jobs in their own process, so the CPU-heavy M3U/EPG parsing
+    does not share a GIL with the web server. Start the web processes with
+    EXTERNAL_SCHEDULER=true; they record job changes in the same database-backed job store.
+    """
+    app = create_app()
+
+    # Jobs added by other processes are only noticed when this scheduler wakes up, so it is
+    # woken on a fixed interval. The poll job lives in memory and never touches the database.
+    from apscheduler.jobstores.memory import MemoryJobStore
+    scheduler.add_jobstore(MemoryJobStore(), 'local')
+    scheduler.add_job(
+        func=poll_job_store, trigger='interval', seconds=app.config['SCHEDULER_POLL_SECONDS'],
+        id='poll_job_store', name='Poll Shared Job Store', jobstore='local', replace_existing=True
+    )
+    app.logger.info(f" --- Scheduler process started (polling every {app.config['SCHEDULER_POLL_SECONDS']}s) --- ")
+
+    # docker stop sends SIGTERM; exit through the shutdown below instead of being killed mid-job
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        threading.Event().wait()
+    except (KeyboardInterrupt, SystemExit):
+        app.logger.info("Shutting down scheduler...")
+        scheduler.shutdown()
+
+if __name__ == '__main__':
+    run()
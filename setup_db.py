@@ -7,6 +7,9 @@ from pathlib import Path
 project_root = Path(__file__).parent
 sys.path.insert(0, str(project_root))
 
+# Schema setup only; don't start the background refresh jobs for this one-off process
+os.environ.setdefault('RUN_SCHEDULER', 'false')
+
 from m3u_server import create_app, db
 
 def init_db():
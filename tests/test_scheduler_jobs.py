@@ -0,0 +1,114 @@
+# tests/test_scheduler_jobs.py
+import functools
+import gzip
+import re
+import sys
+import tempfile
+import threading
+import unittest
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+# Add the project root to the Python path to allow for package imports
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from m3u_server import create_app, db
+from m3u_server.config import Config
+from m3u_server.models import Channel, EpgData, EpgSource, M3uSource
+from m3u_server import scheduler_jobs
+from m3u_server.scheduler_jobs import FilterPatternList, compile_filter_union, has_group_references
+
+class FilterUnionTests(unittest.TestCase):
+    def test_capturing_groups_are_fused(self):
+        union = compile_filter_union(('(HD|SD)', '(adult|xxx)'))
+        self.assertIsInstance(union, re.Pattern)
+        self.assertIsNotNone(union.search('Movies hd'))
+        self.assertIsNotNone(union.search('XXX Channel'))
+        self.assertIsNone(union.search('News'))
+
+    def test_group_references_are_not_fused(self):
+        for pattern in (r'(a)\1', r'(?P<x>a)(?P=x)', r'(a)?(?(1)b|c)'):
+            with self.subTest(pattern=pattern):
+                self.assertTrue(has_group_references(pattern))
+        self.assertFalse(has_group_references(r'(HD|SD)\s+\d'))
+
+        union = compile_filter_union(('(b)x', r'(a)\1'))
+        self.assertIsInstance(union, FilterPatternList)
+        # '\1' keeps referring to its own group: 'aa' matches, 'ab' does not
+        self.assertIsNotNone(union.search('aa'))
+        self.assertIsNone(union.search('ab'))
+        self.assertIsNotNone(union.search('bx'))
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+class CorruptDownloadTests(unittest.TestCase):
+    """Refresh jobs fed broken .gz files log a failed download instead of dying."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp = tempfile.TemporaryDirectory()
+        tmp = Path(cls.tmp.name)
+        (tmp / 'www').mkdir()
+
+        m3u = b'#EXTM3U\n' + b''.join(
+            b'#EXTINF:-1 tvg-id="ch%d" tvg-name="Channel %d",Channel %d\nhttp://x/%d\n' % (i, i, i, i) for i in range(5000)
+        )
+        xml = b'<?xml version="1.0"?>\n<tv>\n' + b''.join(
+            b'<channel id="ch%d"><display-name>Channel %d</display-name></channel>\n' % (i, i) for i in range(5000)
+        ) + b'</tv>\n'
+        # Served without Content-Encoding, like provider '.gz' files; the stream spots the gzip magic
+        m3u_gz, xml_gz = gzip.compress(m3u), gzip.compress(xml)
+        (tmp / 'www' / 'truncated.m3u.gz').write_bytes(m3u_gz[:len(m3u_gz) // 2])
+        (tmp / 'www' / 'corrupt.m3u.gz').write_bytes(b'\x1f\x8b' + b'not really gzip' * 100)
+        (tmp / 'www' / 'truncated.xml.gz').write_bytes(xml_gz[:len(xml_gz) // 2])
+
+        handler = functools.partial(QuietHandler, directory=str(tmp / 'www'))
+        cls.server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.base_url = f'http://127.0.0.1:{cls.server.server_port}/'
+
+        class TestConfig(Config):
+            INSTANCE_PATH = str(tmp)
+            SQLALCHEMY_DATABASE_URI = f"sqlite:///{tmp / 'test.db'}"
+            RUN_SCHEDULER = False
+
+        cls.app = create_app(TestConfig)
+        scheduler_jobs.set_job_app(cls.app)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        with cls.app.app_context():
+            db.session.remove()
+            db.engine.dispose()
+        cls.tmp.cleanup()
+
+    def test_broken_m3u_gzip_is_a_failed_download(self):
+        for source_id, name in enumerate(('truncated.m3u.gz', 'corrupt.m3u.gz'), start=1):
+            with self.subTest(name=name):
+                with self.app.app_context():
+                    db.session.add(M3uSource(id=source_id, url=self.base_url + name))
+                    db.session.commit()
+                with self.assertLogs('m3u_server', level='ERROR') as logs:
+                    scheduler_jobs.refresh_single_m3u_source(source_id, self.base_url + name)
+                self.assertIn('Download failed', '\n'.join(logs.output))
+                with self.app.app_context():
+                    self.assertEqual(db.session.query(Channel).count(), 0)
+                    self.assertIsNone(db.session.get(M3uSource, source_id).last_checked)
+
+    def test_truncated_xmltv_gzip_is_a_failed_download(self):
+        url = self.base_url + 'truncated.xml.gz'
+        with self.app.app_context():
+            db.session.add(EpgSource(id=1, url=url))
+            db.session.commit()
+        with self.assertLogs('m3u_server', level='ERROR') as logs:
+            scheduler_jobs.refresh_single_epg_source(1, url)
+        self.assertIn('Download failed', '\n'.join(logs.output))
+        with self.app.app_context():
+            self.assertEqual(db.session.query(EpgData).count(), 0)
+            self.assertIsNone(db.session.get(EpgSource, 1).last_checked)
+
+if __name__ == '__main__':
+    unittest.main()